@@ -0,0 +1,167 @@
+"""
+Solves many boards for the same pair of ranges, spread over a pool of processes. Each
+solution is appended to a JSON lines file as soon as it is found, and boards already in
+the file are skipped, so an interrupted run can be restarted with the same command.
+
+    python batch.py results.jsonl --boards boards.txt \
+        --hero-range "QcQd KcKd AcAd" --villain-range "QcQd KcKd AcAd" --bet-size .5
+
+boards.txt holds one board per line, such as "2h 3h 4d 6d 7s". A range is a list of
+hands such as "AcAd", each optionally followed by ":weight".
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import sys
+import poker
+import solver
+
+
+def parse_range(text):
+    """
+    Returns the Range described by a string of hands such as "AcAd KsKh:.5", where a
+    hand's weight is 1 unless it is given after a colon.
+    """
+    hand_weights = {}
+    for token in text.replace(',', ' ').split():
+        hand, _, weight = token.partition(':')
+        cards = (poker.Card.from_str(hand[:2]), poker.Card.from_str(hand[2:]))
+        hand_weights[cards] = float(weight) if weight else 1
+    return poker.Range(hand_weights)
+
+
+def format_board(board):
+    """
+    Returns the text used for a board in results files, with its cards in deck order so
+    that the same board is always written the same way.
+    """
+    return ' '.join(str(card) for card in sorted(board, key=lambda card: card.index))
+
+
+def completed_boards(results_path):
+    """
+    Returns the set of boards, as written by format_board, which already have results in
+    results_path. A line left incomplete by an interrupted run is ignored, as are boards
+    which failed, so that they are tried again.
+    """
+    boards = set()
+    if not os.path.exists(results_path):
+        return boards
+    with open(results_path) as results_file:
+        for line in results_file:
+            try:
+                record = json.loads(line)
+                if 'error' not in record:
+                    boards.add(record['board'])
+            except (ValueError, KeyError, TypeError):
+                continue
+    return boards
+
+
+def solve_board(board, hero_range, villain_range, hero='ip', bet_size=1, stack_size=1,
+                starting_pot_size=1, method='lp', iterations=1000):
+    """
+    Solves a single board and returns its result as a dictionary ready to be written as
+    JSON. method is 'lp' for Solver or 'cfr' for CFRSolver, which runs iterations
+    iterations.
+    """
+    board = poker.make_hand(board) if isinstance(board, str) else list(board)
+    solver_class = solver.CFRSolver if method == 'cfr' else solver.Solver
+    problem = solver_class(board, hero_range, villain_range, hero, bet_size, stack_size,
+                           starting_pot_size)
+    if method == 'cfr':
+        result = problem.create_optimal_strategy(iterations)
+    else:
+        result = problem.create_optimal_strategy()
+    plans = problem.strategy_tree.get_plans(hero)
+    hands = [''.join(str(card) for card in poker.COMBOS[combo])
+             for combo in problem.hero_combos]
+    return {'board': format_board(board),
+            'hero': hero,
+            'bet_size': bet_size,
+            'stack_size': stack_size,
+            'starting_pot_size': starting_pot_size,
+            'value': float(result.fun),
+            'success': bool(result.success),
+            'iterations': int(result.nit),
+            'plans': plans,
+            'hands': hands,
+            'strategy': result.x.reshape(len(plans), len(hands)).tolist()}
+
+
+def solve_boards(boards, hero_range, villain_range, results_path, workers=None, **params):
+    """
+    Solves every board not already in results_path using a pool of workers processes
+    (one per CPU if workers is None) and appends each result to results_path as a line
+    of JSON as soon as it is found. params are passed on to solve_board. A board whose
+    solve raises gets a line with its board and an error field instead, and the other
+    boards carry on. Returns the number of boards solved.
+    """
+    done = completed_boards(results_path)
+    pending = []
+    for board in boards:
+        board = poker.make_hand(board) if isinstance(board, str) else list(board)
+        key = format_board(board)
+        if key not in done:
+            done.add(key)
+            pending.append(key)
+    if not pending:
+        return 0
+    with ProcessPoolExecutor(workers) as executor, \
+            open(results_path, 'a+') as results_file:
+        # Start on a new line if an interrupted run left part of one.
+        if results_file.tell():
+            results_file.seek(results_file.tell() - 1)
+            if results_file.read(1) != '\n':
+                results_file.write('\n')
+        futures = {executor.submit(solve_board, board, hero_range, villain_range,
+                                   **params): board
+                   for board in pending}
+        solved = 0
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                solved += 1
+            except Exception as error:
+                result = {'board': futures[future],
+                          'error': '{}: {}'.format(type(error).__name__, error)}
+            results_file.write(json.dumps(result) + '\n')
+            results_file.flush()
+    return solved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('results', help='JSON lines file to append results to')
+    parser.add_argument('--boards', required=True,
+                        help='file with one board per line, or - for standard input')
+    parser.add_argument('--hero-range', required=True)
+    parser.add_argument('--villain-range', required=True)
+    parser.add_argument('--hero', choices=('ip', 'oop'), default='ip')
+    parser.add_argument('--bet-size', type=float, default=1)
+    parser.add_argument('--stack-size', type=float, default=1)
+    parser.add_argument('--starting-pot-size', type=float, default=1)
+    parser.add_argument('--method', choices=('lp', 'cfr'), default='lp')
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='CFR iterations per board')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.boards == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.boards) as boards_file:
+            lines = boards_file.readlines()
+    boards = [line.strip() for line in lines if line.strip()]
+    solved = solve_boards(boards, parse_range(args.hero_range),
+                          parse_range(args.villain_range), args.results, args.workers,
+                          hero=args.hero, bet_size=args.bet_size,
+                          stack_size=args.stack_size,
+                          starting_pot_size=args.starting_pot_size, method=args.method,
+                          iterations=args.iterations)
+    print('Solved {} of {} boards'.format(solved, len(boards)))
+
+
+if __name__ == '__main__':
+    main()
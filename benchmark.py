@@ -1,24 +1,202 @@
-import poker
+"""
+Benchmarks the evaluator, the equity functions, the strategy tree and the solver.
+
+Each benchmark is run a few times to warm up and then timed over several repeats with
+time.perf_counter, on inputs generated from a fixed seed. Results can be written as
+JSON and compared against a baseline written by an earlier run:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --threshold .2
+
+The comparison reports every benchmark whose median time grew by more than the
+threshold, and the exit status is 1 if there were any.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
 import time
-import cProfile
+import numpy as np
+import poker
+import solver
+import strategy
+
+BOARD = poker.make_hand('2h 3h 4d 6d 7s')
+
+
+def _random_range(size, seed):
+    """
+    Returns a range of size random hands which do not conflict with BOARD, with random
+    weights.
+    """
+    rng = np.random.default_rng(seed)
+    live = np.flatnonzero(poker.COMBO_MASKS & poker.hand_mask(BOARD) == 0)
+    weights = np.zeros(poker.NUM_COMBOS)
+    weights[rng.choice(live, size, replace=False)] = rng.random(size)
+    return poker.Range(weights)
+
+
+def bench_evaluate_hand():
+    random.seed(0)
+    hands = [poker.make_random_hand() for _ in range(10000)]
+
+    def run():
+        for hand in hands:
+            poker.evaluate_hand(hand)
+    return run, len(hands)
+
+
+def bench_evaluate_hands_batch():
+    cards = np.random.default_rng(0).random((10000, 52)).argsort(axis=1)[:, :7]
+    return lambda: poker.evaluate_hands_batch(cards), len(cards)
+
+
+def bench_equity_hand_vs_range(size):
+    def setup():
+        villain_range = _random_range(size, 1)
+        hand = poker.make_hand('Ac Kc')
+        return lambda: poker.equity_hand_vs_range(hand, villain_range, BOARD), 1
+    return setup
+
+
+def bench_equity_range_vs_range(size):
+    def setup():
+        hero_range = _random_range(size, 2)
+        villain_range = _random_range(size, 3)
+        return (lambda: poker.equity_range_vs_range(hero_range, villain_range, BOARD), 1)
+    return setup
+
+
+def bench_tree_construction():
+    return lambda: strategy.StrategyTree(BOARD, 1, 10, .5).expand_all(), 1
+
+
+def bench_tree_construction_sizes():
+    return (lambda: strategy.StrategyTree(BOARD, 1, 10, (.33, .75, 1.5)).expand_all(),
+            1)
+
+
+def bench_range_population():
+    tree = strategy.StrategyTree(BOARD, 1, 10, .5)
+    hero_range = _random_range(200, 4)
+    combos = np.flatnonzero(hero_range.weights)
+    plan_weights = np.random.default_rng(5).random((len(tree.get_plans('oop')),
+                                                     len(combos)))
+
+    def run():
+        tree.clear_ranges()
+        tree.set_strategy('oop', plan_weights, combos)
+    return run, 1
+
+
+def bench_solve():
+    hand_range = _random_range(20, 6)
+
+    def run():
+        problem = solver.Solver(BOARD, hand_range, hand_range, 'ip', .5, .5)
+        problem.create_optimal_strategy()
+    return run, 1
+
+
+BENCHMARKS = {
+    'evaluate_hand': bench_evaluate_hand,
+    'evaluate_hands_batch': bench_evaluate_hands_batch,
+    'tree_construction': bench_tree_construction,
+    'tree_construction_sizes': bench_tree_construction_sizes,
+    'range_population': bench_range_population,
+    'solve': bench_solve,
+}
+for size in (10, 100, 1000):
+    BENCHMARKS['equity_hand_vs_range_{}'.format(size)] = bench_equity_hand_vs_range(size)
+    BENCHMARKS['equity_range_vs_range_{}'.format(size)] = (
+        bench_equity_range_vs_range(size))
+del size
+
+
+def time_benchmark(setup, warmup=1, repeat=5):
+    """
+    Runs a benchmark's setup and then its function warmup times untimed and repeat times
+    timed. Returns statistics of the time per item in seconds, where the function handles
+    the number of items returned by setup.
+    """
+    run, items = setup()
+    for _ in range(warmup):
+        run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) / items)
+    return {'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'repeat': repeat,
+            'items': items}
+
+
+def run_benchmarks(names=None, warmup=1, repeat=5):
+    """
+    Runs the named benchmarks, or all of them, and returns the results ready to be
+    written as JSON.
+    """
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if names is None or name in names:
+            results[name] = time_benchmark(setup, warmup, repeat)
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'benchmarks': results}
+
 
-n = 10000
-handlist = []
-for i in range(n):
-    handlist.append(poker.make_random_hand())
+def compare(results, baseline, threshold):
+    """
+    Returns a list of (name, baseline median, median, ratio) for each benchmark whose
+    median time is more than threshold (as a fraction) above the baseline's.
+    """
+    regressions = []
+    for name, stats in results['benchmarks'].items():
+        if name in baseline['benchmarks']:
+            before = baseline['benchmarks'][name]['median']
+            ratio = stats['median'] / before
+            if ratio > 1 + threshold:
+                regressions.append((name, before, stats['median'], ratio))
+    return regressions
 
 
-def temp(hands):
-    for hand in hands:
-        poker.evaluate_hand(hand)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=.1,
+                        help='slowdown which counts as a regression (default: .1)')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
 
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+    results = run_benchmarks(args.names or None, args.warmup, args.repeat)
+    for name, stats in results['benchmarks'].items():
+        print('{:28} median {:12.3f} us  min {:12.3f} us'.format(
+            name, stats['median'] * 1e6, stats['min'] * 1e6))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for name, before, after, ratio in regressions:
+            print('Regression in {}: {:.3f} us -> {:.3f} us ({:.2f}x)'.format(
+                name, before * 1e6, after * 1e6, ratio))
+        return 1 if regressions else 0
+    return 0
 
-cProfile.run('temp(handlist)')
 
-cumtime = 0.0
-for hand in handlist:
-    start = time.time()
-    poker.evaluate_hand(hand)
-    cumtime += time.time() - start
-print('Time to evaluate {} hands: {}'.format(n, cumtime))
-print('Evaluations per second: {}'.format(n / cumtime))
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Counters and phase timers for the evaluator, the strategy tree and the solver. They are
+off by default and cost a single flag check where they are placed; turn them on with
+enable, or for a block with recording, and read them with report:
+
+    with instrument.recording():
+        result = solver.Solver(...).create_optimal_strategy()
+    print(instrument.report())
+
+Only work done in the current process is recorded, so work done in the worker processes
+of parallel.ParallelBestResponse and batch is not.
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import time
+
+enabled = False
+counters = Counter()
+# Total seconds spent in each timed phase and the number of times it was entered.
+timer_seconds = defaultdict(float)
+timer_calls = Counter()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    counters.clear()
+    timer_seconds.clear()
+    timer_calls.clear()
+
+
+def count(name, amount=1):
+    """
+    Adds amount to the counter called name if instrumentation is enabled. Hot paths
+    should check enabled before calling this.
+    """
+    if enabled:
+        counters[name] += amount
+
+
+@contextmanager
+def timer(name):
+    """
+    Adds the time spent in the block to the timer called name if instrumentation is
+    enabled.
+    """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer_seconds[name] += time.perf_counter() - start
+        timer_calls[name] += 1
+
+
+@contextmanager
+def recording():
+    """
+    Resets the counters and timers and enables instrumentation for the block, restoring
+    the previous setting afterwards.
+    """
+    global enabled
+    previous = enabled
+    reset()
+    enabled = True
+    try:
+        yield
+    finally:
+        enabled = previous
+
+
+def report():
+    """
+    Returns the counters and timers as a dictionary ready to be written as JSON.
+    """
+    return {'counters': dict(counters),
+            'timers': {name: {'seconds': seconds, 'calls': timer_calls[name]}
+                       for name, seconds in timer_seconds.items()}}
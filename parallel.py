@@ -0,0 +1,82 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import strategy
+
+# Arrays and plans set up in each worker process by _init_worker.
+_worker_state = {}
+
+
+def _init_worker(array_specs, player, branches):
+    for key, (name, shape) in array_specs.items():
+        memory = shared_memory.SharedMemory(name=name)
+        _worker_state[key] = np.ndarray(shape, buffer=memory.buf)
+        _worker_state[key + '_memory'] = memory
+    _worker_state['player'] = player
+    _worker_state['branches'] = branches
+
+
+def _evaluate_hands(start, stop, gradient):
+    state = _worker_state
+    return strategy.best_response_ev(state['player'], state['branches'], state['ranges'],
+                                     state['wins'][start:stop],
+                                     state['compatible'][start:stop],
+                                     state['weights'][start:stop], gradient)
+
+
+class ParallelBestResponse:
+    """
+    Evaluates StrategyTree.create_counter_strategy for a fixed responding range and
+    showdown with the responding hands split between a pool of worker processes. The
+    showdown matrices, hand weights and node ranges live in shared memory, so each call
+    only copies the current node ranges into it and sends the workers their slices.
+    The counter plans, which hold the tree's pot sizes, are sent once when the workers
+    start. Call close, or use as a context manager, to stop the workers and free the
+    shared memory.
+    """
+    def __init__(self, tree, player, hand_range, showdown, workers):
+        self.tree = tree
+        self.showdown = showdown
+        self.nodes, branches = tree.get_counter_plans(player)
+        arrays = {'ranges': np.zeros((len(self.nodes), len(showdown.hero_combos))),
+                  'wins': showdown.wins,
+                  'compatible': showdown.compatible,
+                  'weights': hand_range.weights[showdown.villain_combos]}
+        self.memory = []
+        self.arrays = {}
+        array_specs = {}
+        for key, array in arrays.items():
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.memory.append(memory)
+            self.arrays[key] = np.ndarray(array.shape, buffer=memory.buf)
+            self.arrays[key][...] = array
+            array_specs[key] = (memory.name, array.shape)
+        bounds = np.linspace(0, len(showdown.villain_combos), workers + 1).astype(int)
+        self.slices = [(start, stop) for start, stop in zip(bounds, bounds[1:])
+                       if stop > start] or [(0, 0)]
+        self.executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                            initargs=(array_specs, player, branches))
+
+    def __call__(self, gradient=False):
+        self.arrays['ranges'][...] = self.tree.ranges[np.ix_(self.nodes,
+                                                             self.showdown.hero_combos)]
+        results = list(self.executor.map(_evaluate_hands,
+                                         *zip(*((start, stop, gradient)
+                                                for start, stop in self.slices))))
+        if not gradient:
+            return sum(results)
+        return (sum(total_ev for total_ev, node_gradients in results),
+                sum(node_gradients for total_ev, node_gradients in results))
+
+    def close(self):
+        self.executor.shutdown()
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+        self.memory = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
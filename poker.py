@@ -1,65 +1,298 @@
-from collections import Counter, defaultdict, namedtuple
-from itertools import islice, chain
+from collections import namedtuple
+from collections.abc import MutableMapping
+from functools import lru_cache
+from itertools import (combinations, combinations_with_replacement, count, groupby,
+                       permutations)
+import os
 import random
+import time
 
-RankCount = namedtuple("Rankcount", ["count", "rank"])
+import numpy as np
+import instrument
+import tables
 
 
 class Card:
+    """
+    A playing card. There is exactly one instance of each card, stored in DECK, so cards
+    can be compared by identity. A card's index is its position in DECK and its mask is
+    a 52 bit integer with only the bit for its index set. Its key is what it adds to the
+    key of a hand, which hand_strength looks up.
+    """
     SUITS = "shdc"
     RANKS = "23456789TJQKA"
+    __slots__ = ('rank', 'suit', 'index', 'mask', 'key')
 
-    def __init__(self, rank, suit):
-        self.rank = rank
-        self.suit = suit
+    def __new__(cls, rank, suit):
+        if not (0 <= rank < 13 and 0 <= suit < 4):
+            raise ValueError('Invalid card')
+        return DECK[rank * 4 + suit]
+
+    @classmethod
+    def _create(cls, rank, suit):
+        card = object.__new__(cls)
+        card.rank = rank
+        card.suit = suit
+        card.index = rank * 4 + suit
+        card.mask = 1 << card.index
+        return card
 
     @classmethod
     def from_str(cls, s):
         return cls(cls.RANKS.index(s[0]), cls.SUITS.index(s[1]))
 
-    def __eq__(self, other):
-        return self.rank == other.rank and self.suit == other.suit
+    def __reduce__(self):
+        return (Card, (self.rank, self.suit))
 
     def __lt__(self, other):
         return self.rank <= other.rank and self.suit < other.suit
 
     def __hash__(self):
-        return self.suit * 13 + self.rank
+        return self.index
 
     def __repr__(self):
-        return "Card(" + self.RANKS[self.rank] + self.SUITS[self.suit] + ")"
+        return "Card(" + str(self) + ")"
+
+    def __str__(self):
+        return self.RANKS[self.rank] + self.SUITS[self.suit]
+
+
+DECK = tuple(Card._create(rank, suit) for rank in range(13) for suit in range(4))
+
+# Every two card hand, each stored once with its lower indexed card first. A hand's
+# position in COMBOS is its combo index.
+COMBOS = tuple(combinations(DECK, 2))
+NUM_COMBOS = len(COMBOS)
+COMBO_CARDS = np.array([[a.index, b.index] for a, b in COMBOS], dtype=np.int64)
+COMBO_MASKS = np.array([a.mask | b.mask for a, b in COMBOS], dtype=np.int64)
+COMBO_INDICES = [[-1] * 52 for _ in range(52)]
+for i, (a, b) in enumerate(COMBOS):
+    COMBO_INDICES[a.index][b.index] = COMBO_INDICES[b.index][a.index] = i
+del i, a, b
+
+# Every permutation of the four suits, with the index each card and combo is moved to by
+# each permutation, and the number of each permutation's inverse.
+SUIT_PERMUTATIONS = tuple(permutations(range(4)))
+PERMUTED_CARDS = np.array([[card.rank * 4 + permutation[card.suit] for card in DECK]
+                           for permutation in SUIT_PERMUTATIONS], dtype=np.int64)
+PERMUTED_COMBOS = np.array([[COMBO_INDICES[cards[a]][cards[b]]
+                             for a, b in COMBO_CARDS.tolist()]
+                            for cards in PERMUTED_CARDS.tolist()], dtype=np.int64)
+INVERSE_PERMUTATIONS = tuple(SUIT_PERMUTATIONS.index(tuple(np.argsort(permutation)))
+                             for permutation in SUIT_PERMUTATIONS)
+PERMUTED_CARD_LISTS = PERMUTED_CARDS.tolist()
+
+
+def combo_index(hand):
+    """
+    Returns the combo index of a hand of two distinct cards, in either order.
+    """
+    a, b = hand
+    i = COMBO_INDICES[a.index][b.index]
+    if i < 0:
+        raise KeyError(hand)
+    return i
+
+
+def canonical_board(board):
+    """
+    Returns a pair (mask, permutation). mask is the lowest 52 bit mask of any suit
+    permutation of board, so boards which are suit permutations of each other share it,
+    and permutation is the number in SUIT_PERMUTATIONS of a permutation which takes
+    board to the board with that mask.
+    """
+    indices = [card.index for card in board]
+    return min((sum(1 << cards[i] for i in indices), permutation)
+               for permutation, cards in enumerate(PERMUTED_CARD_LISTS))
+
+
+class SuitIsomorphism:
+    """
+    The suit permutations which leave a board and some ranges unchanged. Hands which
+    these permutations move into each other play identically, so a problem on the board
+    can be solved with one representative of each class of such hands. classes holds
+    the combo index of the representative of every combo's class.
+    """
+    def __init__(self, board, *ranges):
+        board_mask = hand_mask(board)
+        self.permutations = [
+            permutation for permutation, cards in enumerate(PERMUTED_CARD_LISTS)
+            if sum(1 << cards[card.index] for card in board) == board_mask
+            and all(np.array_equal(hand_range.weights[PERMUTED_COMBOS[permutation]],
+                                   hand_range.weights)
+                    for hand_range in ranges)]
+        self.classes = PERMUTED_COMBOS[self.permutations].min(axis=0)
+
+    def reduce_range(self, hand_range):
+        """
+        Returns a range holding the total weight of each class on its representative.
+        """
+        return Range(np.bincount(self.classes, hand_range.weights, minlength=NUM_COMBOS))
+
+    def reduce_showdown(self, showdown):
+        """
+        Returns a Showdown between the class representatives of a showdown's hands, to be
+        used with ranges from reduce_range. A representative hero hand stands for its
+        whole class, so its column averages the class's columns; the villain rows of a
+        class are the same up to a permutation of the hero hands, so they are averaged
+        too.
+        """
+        reduced = Showdown.__new__(Showdown)
+        reduced.key = next(_showdown_keys)
+        reduced.hero_combos, hero_sums = self._class_matrix(showdown.hero_combos)
+        reduced.villain_combos, villain_sums = self._class_matrix(showdown.villain_combos)
+        hero_means = hero_sums / hero_sums.sum(axis=0)
+        villain_means = (villain_sums / villain_sums.sum(axis=0)).T
+        reduced.wins = villain_means @ showdown.wins @ hero_means
+        reduced.compatible = villain_means @ showdown.compatible @ hero_means
+        return reduced
+
+    def expand(self, weights, reduced_combos, combos):
+        """
+        Takes an array whose last axis holds a value for each representative in
+        reduced_combos and shares each value equally between the hands of its class,
+        returning an array whose last axis follows combos.
+        """
+        positions = np.searchsorted(reduced_combos, self.classes[combos])
+        class_sizes = np.bincount(positions, minlength=len(reduced_combos))
+        return np.asarray(weights)[..., positions] / class_sizes[positions]
+
+    def reduce(self, weights, combos):
+        """
+        Takes an array whose last axis holds a value for each of the given combos and
+        returns one whose last axis holds the total for each of their classes, in order
+        of representative.
+        """
+        return np.asarray(weights) @ self._class_matrix(combos)[1]
+
+    def _class_matrix(self, combos):
+        """
+        Returns the sorted representatives of the classes of the given combos, and a
+        matrix with a row for each combo and a column for each representative which is 1
+        where the combo is in the representative's class.
+        """
+        representatives, positions = np.unique(self.classes[combos], return_inverse=True)
+        matrix = np.zeros((len(combos), len(representatives)))
+        matrix[np.arange(len(combos)), positions] = 1
+        return representatives, matrix
+
+
+def _mask_indices(mask):
+    """
+    Returns a list of the indices of the cards in a 52 bit mask.
+    """
+    indices = []
+    while mask:
+        low = mask & -mask
+        indices.append(low.bit_length() - 1)
+        mask ^= low
+    return indices
+
+
+class HandWeights(MutableMapping):
+    """
+    A dict-like view of a Range's weights keyed by two card hands. Hands not in the range
+    have weight 0 and are left out when iterating.
+    """
+    def __init__(self, hand_range):
+        self.range = hand_range
+
+    def __getitem__(self, hand):
+        return float(self.range.weights[combo_index(hand)])
+
+    def __setitem__(self, hand, weight):
+        self.range.weights[combo_index(hand)] = weight
+        self.range.changed()
+
+    def __delitem__(self, hand):
+        self[hand] = 0
+
+    def __contains__(self, hand):
+        try:
+            return self.range.weights[combo_index(hand)] != 0
+        except (KeyError, TypeError):
+            return False
+
+    def __iter__(self):
+        return (COMBOS[i] for i in np.flatnonzero(self.range.weights))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.range.weights))
+
+    def items(self):
+        weights = self.range.weights
+        nonzero = np.flatnonzero(weights)
+        return list(zip((COMBOS[i] for i in nonzero.tolist()), weights[nonzero].tolist()))
+
+    def values(self):
+        weights = self.range.weights
+        return weights[weights != 0].tolist()
 
 
 class Range:
+    """
+    A weighted range of two card hands stored as an array of NUM_COMBOS weights indexed by
+    combo. hand_weights gives a dict-like view of the same weights. Code which modifies
+    the weights array directly must call changed() afterwards.
+    """
     def __init__(self, hand_weights=None):
-        if hand_weights is None:
-            self.hand_weights = defaultdict(float)
+        if isinstance(hand_weights, np.ndarray):
+            self.weights = np.array(hand_weights, dtype=float)
         else:
-            self.hand_weights = defaultdict(float, hand_weights)
+            self.weights = np.zeros(NUM_COMBOS)
+            if hand_weights is not None:
+                for hand, weight in hand_weights.items():
+                    self.weights[combo_index(hand)] = weight
+        self.hand_weights = HandWeights(self)
+        self.changed()
+
+    def changed(self):
+        self._total = None
+        self._card_weights = None
+
+    @property
+    def card_weights(self):
+        """
+        A list holding, for each card, the total weight of the hands which contain it.
+        """
+        if self._card_weights is None:
+            self._card_weights = np.bincount(COMBO_CARDS.ravel(),
+                                             np.repeat(self.weights, 2),
+                                             minlength=52).tolist()
+        return self._card_weights
 
     def size(self, remove=()):
-        return sum(w for h, w in self.hand_weights.items() if set(h).isdisjoint(remove))
+        """
+        Returns the total weight of the hands in the range which do not contain any of
+        the cards in remove. Every hand contains exactly two cards, so this is the total
+        weight less the weight containing each removed card plus the weight containing
+        each pair of removed cards.
+        """
+        if self._total is None:
+            self._total = float(self.weights.sum())
+        removed = _mask_indices(hand_mask(remove))
+        if not removed:
+            return self._total
+        card_weights = self.card_weights
+        size = self._total
+        for i, card in enumerate(removed):
+            size -= card_weights[card]
+            for other in removed[i + 1:]:
+                size += self.weights[COMBO_INDICES[card][other]]
+        return size
 
     def normalize(self):
-        mult = 1 / self.size()
-        for hand in self.hand_weights:
-            self.hand_weights[hand] *= mult
+        self.weights *= 1 / self.size()
+        self.changed()
 
     def __add__(self, other):
-        result = {}
-        for hand in (set(list(self.hand_weights.keys()))
-                     ).union(set(list(other.hand_weights.keys()))):
-            result[hand] = self.hand_weights[hand] + other.hand_weights[hand]
-        return Range(result)
+        return Range(self.weights + other.weights)
 
     def __repr__(self):
         return ('Range with size ' + str(self.size()) + ':\n'
                 + '\n'.join(str(h) + ': ' + str(w) for h, w in self.hand_weights.items()))
 
 
-DECK = tuple(Card(rank, suit) for rank in range(13) for suit in range(4))
-
-
 def make_hand(cards_str):
     return [Card.from_str(s) for s in cards_str.split()]
 
@@ -68,72 +301,225 @@ def make_random_hand(hand_size=7):
     return random.sample(DECK, hand_size)
 
 
-def get_kickers(cards, ignore=()):
+def hand_mask(cards):
     """
-    Returns a generator of card ranks from high to low excluding card(s) having rank equal
-    to any in ignore.
+    Returns a 52 bit mask of the given cards. If cards is already a mask it is returned
+    unchanged.
     """
-    # Assumes cards are sorted by rank from high to low
-    return (card.rank for card in cards if card.rank not in ignore)
+    if isinstance(cards, int):
+        return cards
+    mask = 0
+    for card in cards:
+        mask |= card.mask
+    return mask
 
 
-def get_straight(cards):
+def _straight_high(rank_mask):
     """
-    Checks to see if cards include a five card straight. If they do, returns the rank of
-    the highest card in the highest straight; otherwise returns None.
+    Returns the rank of the highest card in the highest straight contained in a 13 bit
+    mask of ranks, or None if there is no straight.
     """
-    # Assumes cards are sorted by rank from high to low
-    last_rank = -1
-    count = 1
-    for rank in (card.rank for card in cards):
-        if rank == last_rank - 1:
-            if count == 4:
-                return rank + 4
-            count += 1
-        elif rank != last_rank:
-            count = 1
-        last_rank = rank
-    if count == 4 and last_rank == 0 and cards[0].rank == 12:
+    for high in range(12, 3, -1):
+        window = 0b11111 << (high - 4)
+        if rank_mask & window == window:
+            return high
+    if rank_mask & WHEEL_MASK == WHEEL_MASK:
         return 3
 
 
-def get_flush(cards):
+def _pack_strength(hand_rank, kickers):
     """
-    Checks to see if the cards include a flush. If they do, returns a tuple containing the
-    ranks of the highest five card flush; otherwise returns None.
+    Packs a hand rank and up to five kicker ranks into a single integer, four bits per
+    rank, so that integer comparison matches comparison of (hand rank, kickers) tuples.
     """
-    # Assumes cards are sorted by rank from high to low
-    by_suit = defaultdict(list)
-    for card in cards:
-        by_suit[card.suit].append(card.rank)
-        if len(by_suit[card.suit]) == 5:
-            return tuple(by_suit[card.suit])
+    strength = hand_rank
+    for kicker in kickers:
+        strength = strength << 4 | kicker
+    return strength << 4 * (5 - len(kickers))
+
 
+def _unpack_strength(strength):
+    hand_rank = strength >> 20
+    kickers = tuple(strength >> 16 - 4 * i & 15 for i in range(KICKER_COUNTS[hand_rank]))
+    if len(kickers) == 1:
+        return (hand_rank, kickers[0])
+    return (hand_rank, kickers)
 
-def get_straightflush(cards):
+
+def _five_card_strength(ranks):
     """
-    Checks to see if the cards include a straight flush. If they do, returns the rank of
-    the highest card in the highest straight flush; otherwise returns None.
+    Takes the ranks of five cards which do not make a flush, sorted from high to low, and
+    returns the strength of the hand they make.
     """
-    # Assumes cards are sorted by rank from high to low
-    possible = []
-    for card in cards:
-        for start in possible:
-            if (card.suit, card.rank) == (start[-1].suit, start[-1].rank - 1):
-                if len(start) == 4:
-                    return start[0].rank
-                start.append(card)
+    groups = sorted(((len(list(cards)), rank) for rank, cards in groupby(ranks)),
+                    reverse=True)
+    counts = tuple(count for count, rank in groups)
+    kickers = tuple(rank for count, rank in groups)
+    if counts == (1, 1, 1, 1, 1):
+        straight = _straight_high(sum(1 << rank for rank in ranks))
+        if straight is not None:
+            return _pack_strength(4, (straight,))
+    return _pack_strength(PATTERN_HAND_RANKS[counts], kickers)
+
+
+def _flush_strength(rank_mask):
+    straight = _straight_high(rank_mask)
+    if straight is not None:
+        return _pack_strength(8, (straight,))
+    return _pack_strength(5, [rank for rank in range(12, -1, -1)
+                              if rank_mask >> rank & 1][:5])
+
+
+def _perfect_hash(table):
+    """
+    Takes a dictionary with integer keys and returns the lists (displacements, values)
+    of a perfect hash of it: the value for key is stored at
+    values[(key + displacements[key % len(displacements)]) % len(values)], and no two
+    keys share a slot. Keys are put in buckets by key % len(displacements), and each
+    bucket, largest first, is given the first displacement which moves all its keys to
+    free slots. Unused slots hold 0.
+    """
+    num_slots = int(len(table) * 1.25) | 1
+    buckets = [[] for _ in range(len(table) // 4)]
+    for key in table:
+        buckets[key % len(buckets)].append(key)
+    displacements = [0] * len(buckets)
+    values = [0] * num_slots
+    used = bytearray(num_slots)
+    for bucket in sorted(range(len(buckets)), key=lambda b: -len(buckets[b])):
+        keys = buckets[bucket]
+        if not keys:
+            break
+        for displacement in range(num_slots):
+            slots = {(key + displacement) % num_slots for key in keys}
+            if len(slots) == len(keys) and not any(used[slot] for slot in slots):
                 break
         else:
-            possible.append([card])
-    for start in possible:
-        if len(start) == 4 and start[-1].rank == 0:
-            suit = start[-1].suit
-            for card in cards:
-                if card.rank < 12:
-                    break
-                elif card.suit == suit:
-                    return 3
+            raise ValueError('No perfect hash found')
+        displacements[bucket] = displacement
+        for key in keys:
+            slot = (key + displacement) % num_slots
+            used[slot] = 1
+            values[slot] = table[key]
+    return displacements, values
+
+
+def build_table_arrays():
+    """
+    Builds the lookup tables used by hand_strength and evaluate_hands_batch as a
+    dictionary of arrays. Hands without a flush are looked up by their rank counts; a
+    hand of six or seven cards is as strong as its strongest subset with one card fewer.
+    Their strengths are stored in rank_values at the slots given by _perfect_hash, so
+    that they can be looked up without a search.
+    """
+    rank_table = {}
+    for num_cards in range(5, 8):
+        for ranks in combinations_with_replacement(range(12, -1, -1), num_cards):
+            if any(ranks[i] == ranks[i + 4] for i in range(num_cards - 4)):
+                continue
+            key = sum(RANK_KEYS[rank] for rank in ranks)
+            if num_cards == 5:
+                rank_table[key] = _five_card_strength(ranks)
+            else:
+                rank_table[key] = max(rank_table[key - RANK_KEYS[rank]]
+                                      for rank in set(ranks))
+    flush_table = [0] * (1 << 13)
+    for rank_mask in range(1 << 13):
+        if bin(rank_mask).count('1') >= 5:
+            flush_table[rank_mask] = _flush_strength(rank_mask)
+    suit_table = [-1] * (1 << RANK_SHIFT)
+    for suit_counts in range(1 << RANK_SHIFT):
+        for suit in range(4):
+            if suit_counts >> SUIT_BITS * suit & SUIT_FIELD >= 5:
+                suit_table[suit_counts] = suit
+    displacements, rank_values = _perfect_hash(rank_table)
+    return {'rank_displacements': np.array(displacements, dtype=np.int64),
+            'rank_values': np.array(rank_values, dtype=np.int64),
+            'flush': np.array(flush_table, dtype=np.int64),
+            'suit': np.array(suit_table, dtype=np.int64)}
+
+
+def _load_table_arrays():
+    """
+    Returns the arrays from build_table_arrays, mapped from the file at TABLES_PATH. If
+    the file is missing or invalid the tables are built instead, and saved there for
+    next time if possible.
+    """
+    try:
+        return tables.load(TABLES_PATH, TABLES_VERSION)
+    except (OSError, ValueError, tables.TableError):
+        pass
+    arrays = build_table_arrays()
+    try:
+        tables.save(TABLES_PATH, arrays, TABLES_VERSION)
+    except OSError:
+        pass
+    return arrays
+
+
+# A hand's key is the sum of its cards' keys. The high part of the key holds the hand's
+# rank counts written in base 5 and the low part holds a three bit count for each suit.
+SUIT_BITS = 3
+SUIT_FIELD = (1 << SUIT_BITS) - 1
+RANK_SHIFT = 4 * SUIT_BITS
+SUIT_MASK = (1 << RANK_SHIFT) - 1
+RANK_KEYS = tuple(5 ** rank for rank in range(13))
+CARD_KEYS = tuple(RANK_KEYS[card.rank] << RANK_SHIFT | 1 << SUIT_BITS * card.suit
+                  for card in DECK)
+for card in DECK:
+    card.key = CARD_KEYS[card.index]
+del card
+WHEEL_MASK = 0b1000000001111
+PATTERN_HAND_RANKS = {(1, 1, 1, 1, 1): 0, (2, 1, 1, 1): 1, (2, 2, 1): 2, (3, 1, 1): 3,
+                      (3, 2): 6, (4, 1): 7}
+KICKER_COUNTS = (5, 4, 3, 3, 1, 5, 2, 2, 1)
+
+# The tables are kept in a file, rebuilt with "python tables.py", which is shared
+# between processes. TABLES_VERSION must change whenever the tables' contents do.
+TABLES_PATH = os.environ.get('POKER_TABLES', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'poker_tables.bin'))
+TABLES_VERSION = 2
+_TABLE_ARRAYS = _load_table_arrays()
+
+# Both hand_strength and evaluate_hands_batch read the mapped arrays, so no process
+# keeps its own copy of the tables. evaluate_hands_batch views them as plain arrays,
+# and hand_strength reads them through memoryviews, which index to Python integers
+# without the cost of creating a numpy scalar.
+CARD_KEY_ARRAY = np.array(CARD_KEYS, dtype=np.int64)
+RANK_DISPLACEMENT_ARRAY = _TABLE_ARRAYS['rank_displacements'].view(np.ndarray)
+RANK_VALUE_ARRAY = _TABLE_ARRAYS['rank_values'].view(np.ndarray)
+FLUSH_ARRAY = _TABLE_ARRAYS['flush'].view(np.ndarray)
+SUIT_ARRAY = _TABLE_ARRAYS['suit'].view(np.ndarray)
+RANK_DISPLACEMENTS = memoryview(RANK_DISPLACEMENT_ARRAY)
+RANK_VALUES = memoryview(RANK_VALUE_ARRAY)
+FLUSH_VALUES = memoryview(FLUSH_ARRAY)
+SUITS = memoryview(SUIT_ARRAY)
+NUM_BUCKETS = len(RANK_DISPLACEMENTS)
+NUM_SLOTS = len(RANK_VALUES)
+# There are only 7462 distinct strengths, so their tuples are cheap to keep.
+HAND_TUPLES = {strength: _unpack_strength(strength)
+               for strength in np.union1d(RANK_VALUE_ARRAY, FLUSH_ARRAY).tolist()
+               if strength}
+
+
+def hand_strength(cards):
+    """
+    Takes an iterable containing between 5 and 7 cards. Returns an integer which is
+    greater for stronger hands and equal for hands of equal strength.
+    """
+    cards = tuple(cards)
+    if len(cards) < 5 or len(cards) > 7:
+        raise ValueError('Hand must have between 5 and 7 cards')
+    if instrument.enabled:
+        instrument.count('hand_strength')
+    key = 0
+    for card in cards:
+        key += card.key
+    suit = SUITS[key & SUIT_MASK]
+    if suit < 0:
+        key >>= RANK_SHIFT
+        return RANK_VALUES[(key + RANK_DISPLACEMENTS[key % NUM_BUCKETS]) % NUM_SLOTS]
+    return FLUSH_VALUES[sum(1 << card.rank for card in cards if card.suit == suit)]
 
 
 def evaluate_hand(cards):
@@ -142,108 +528,355 @@ def evaluate_hand(cards):
     (hand rank, kickers). If one hand is stronger than another, its return value will be
     greater when they are compared.
     """
-    cards = sorted(cards, key=lambda x: x.rank, reverse=True)
-    if len(cards) < 5 or len(cards) > 7:
+    return HAND_TUPLES[hand_strength(cards)]
+
+
+def evaluate_hands_batch(cards_array):
+    """
+    Takes an N x 5..7 array of card indices, where a card's index is its position in
+    DECK. Returns an array of length N containing the strength of each hand, as given by
+    hand_strength.
+    """
+    cards_array = np.asarray(cards_array, dtype=np.int64)
+    if cards_array.ndim != 2 or cards_array.shape[1] < 5 or cards_array.shape[1] > 7:
         raise ValueError('Hand must have between 5 and 7 cards')
+    if instrument.enabled:
+        instrument.count('batch_hand_strength', len(cards_array))
+    keys = CARD_KEY_ARRAY[cards_array].sum(axis=1)
+    rank_keys = keys >> RANK_SHIFT
+    strengths = RANK_VALUE_ARRAY[(rank_keys + RANK_DISPLACEMENT_ARRAY[
+        rank_keys % NUM_BUCKETS]) % NUM_SLOTS]
+    suits = SUIT_ARRAY[keys & SUIT_MASK]
+    flushes = np.flatnonzero(suits >= 0)
+    if len(flushes):
+        flush_cards = cards_array[flushes]
+        in_suit = flush_cards % 4 == suits[flushes, np.newaxis]
+        rank_masks = (in_suit << flush_cards // 4).sum(axis=1)
+        strengths[flushes] = FLUSH_ARRAY[rank_masks]
+    return strengths
+
+
+def _live_combos(hand_range, dead_cards):
+    """
+    Returns the combo indices of the hands with weight in a range which do not contain
+    any of the cards in the 52 bit mask dead_cards.
+    """
+    return np.flatnonzero((hand_range.weights != 0) & (COMBO_MASKS & dead_cards == 0))
+
+
+def _board_strengths(combos, board):
+    """
+    Returns the strength of each of the given combos combined with the board.
+    """
+    board_array = np.broadcast_to([card.index for card in board],
+                                  (len(combos), len(board)))
+    return evaluate_hands_batch(np.hstack((COMBO_CARDS[combos], board_array)))
+
+
+def _check_complete(board):
+    """
+    Raises ValueError unless board has all five cards. Showdowns are only defined on a
+    complete board; runout_equity handles boards with cards to come.
+    """
+    if len(board) != 5:
+        raise ValueError('A showdown needs a board of 5 cards, not {}; use runout_equity '
+                         'for boards with cards to come'.format(len(board)))
+
+
+class RankedBoard:
+    """
+    Every hand which can be held on a complete board, sorted by strength. With the hands
+    in this order, the weight of a range which each hand beats, ties or is compatible
+    with can be found for all hands at once from prefix sums of the range's weights.
+    Raises ValueError if the board is not complete.
+    """
+    def __init__(self, board):
+        _check_complete(board)
+        if instrument.enabled:
+            instrument.count('ranked_boards')
+        self.board = tuple(board)
+        self.mask = hand_mask(board)
+        live = np.flatnonzero(COMBO_MASKS & self.mask == 0)
+        strengths = _board_strengths(live, board)
+        order = np.argsort(strengths, kind='stable')
+        # Live combos sorted from weakest to strongest, and for each one the positions in
+        # that order where its group of equally strong hands starts and ends.
+        self.combos = live[order]
+        self.cards = COMBO_CARDS[self.combos]
+        sorted_strengths = strengths[order]
+        self.lower = np.searchsorted(sorted_strengths, sorted_strengths, 'left')
+        self.upper = np.searchsorted(sorted_strengths, sorted_strengths, 'right')
+        self.strengths = np.full(NUM_COMBOS, -1, dtype=np.int64)
+        self.strengths[self.combos] = sorted_strengths
+
+    def permuted(self, permutation):
+        """
+        Returns the RankedBoard for the board given by applying a suit permutation,
+        numbered as in SUIT_PERMUTATIONS, to this one, without evaluating any hands.
+        """
+        combo_map = PERMUTED_COMBOS[permutation]
+        result = RankedBoard.__new__(RankedBoard)
+        result.board = tuple(DECK[PERMUTED_CARDS[permutation, card.index]]
+                             for card in self.board)
+        result.mask = hand_mask(result.board)
+        result.combos = combo_map[self.combos]
+        result.cards = COMBO_CARDS[result.combos]
+        result.lower = self.lower
+        result.upper = self.upper
+        result.strengths = np.empty_like(self.strengths)
+        result.strengths[combo_map] = self.strengths
+        return result
+
+    def showdown_weights(self, villain_range):
+        """
+        Returns three arrays holding, for each combo, the weight of the hands in
+        villain_range which it beats, ties and does not share a card with. Combos which
+        conflict with the board have 0 for all three.
+        """
+        weights = villain_range.weights[self.combos]
+        num_live = len(weights)
+        # Prefix sums of the sorted weights, overall and restricted to hands holding each
+        # card. A hand's own weight is added back because it holds both of its cards.
+        total = np.concatenate(([0], np.cumsum(weights)))
+        by_card = np.zeros((num_live + 1, 52))
+        rows = np.arange(1, num_live + 1)
+        by_card[rows, self.cards[:, 0]] = weights
+        by_card[rows, self.cards[:, 1]] = weights
+        np.cumsum(by_card, axis=0, out=by_card)
+
+        def compatible_before(position):
+            return (total[position]
+                    - by_card[position, self.cards[:, 0]]
+                    - by_card[position, self.cards[:, 1]])
+
+        results = np.zeros((3, NUM_COMBOS))
+        results[0, self.combos] = compatible_before(self.lower)
+        results[1, self.combos] = (compatible_before(self.upper)
+                                   - compatible_before(self.lower) + weights)
+        results[2, self.combos] = compatible_before(num_live) + weights
+        return results
+
+
+@lru_cache(maxsize=64)
+def _canonical_ranked_board(canonical_mask):
+    return RankedBoard([DECK[i] for i in _mask_indices(canonical_mask)])
+
+
+@lru_cache(maxsize=64)
+def _ranked_board(board_mask):
+    board = [DECK[i] for i in _mask_indices(board_mask)]
+    canonical_mask, permutation = canonical_board(board)
+    ranked = _canonical_ranked_board(canonical_mask)
+    if canonical_mask == board_mask:
+        return ranked
+    return ranked.permuted(INVERSE_PERMUTATIONS[permutation])
+
+
+def ranked_board(board):
+    """
+    Returns the RankedBoard for a complete board. Recently used boards are cached, and
+    boards which are suit permutations of each other share the hand evaluations.
+    Raises ValueError if the board is not complete.
+    """
+    _check_complete(board)
+    return _ranked_board(hand_mask(board))
+
+
+# Unique keys for Showdowns, so that results computed from one can be cached.
+_showdown_keys = count()
+
 
-    flush = get_flush(cards)
-    straight = get_straight(cards)
-    if flush and straight:
-        straightflush = get_straightflush(cards)
-    else:
-        straightflush = None
-    rank_counts = Counter(card.rank for card in cards)
-    rank_counts = [RankCount(count, item) for item, count in rank_counts.items()]
-    rank_counts.sort(reverse=True)
-    primary = rank_counts[0]
-    secondary = rank_counts[1]
-
-    if straightflush:
-        hand_rank = 8
-        kicker = straightflush
-    elif primary.count == 4:
-        hand_rank = 7
-        kicker = (rank_counts[0].rank, next(get_kickers(cards, ignore=(primary.rank,))))
-    elif primary.count == 3 and secondary.count >= 2:
-        hand_rank = 6
-        kicker = (primary.rank, secondary.rank)
-    elif flush:
-        hand_rank = 5
-        kicker = flush
-    elif straight:
-        hand_rank = 4
-        kicker = straight
-    elif primary.count == 3:
-        hand_rank = 3
-        kicker = (primary.rank, *islice(get_kickers(cards, ignore=(primary.rank,)), 2))
-    elif primary.count == secondary.count == 2:
-        hand_rank = 2
-        extra_kicker = next(get_kickers(cards, ignore=((primary.rank,), secondary.rank)))
-        kicker = (primary.rank, secondary.rank, extra_kicker)
-    elif primary.count == 2:
-        hand_rank = 1
-        extra_kickers = islice(get_kickers(cards, ignore=(primary.rank,)), 3)
-        kicker = (primary.rank, *extra_kickers)
-    else:
-        hand_rank = 0
-        kicker = tuple(islice(get_kickers(cards), 5))
-    return (hand_rank, kicker)
+class Showdown:
+    """
+    The outcome of a showdown on a complete board between each hand in a villain range
+    and each hand in a hero range. Hands are listed by combo index in villain_combos and
+    hero_combos. wins[i, j] is 1 if the i-th villain hand beats the j-th hero hand, .5 if
+    they tie and 0 if it loses, and compatible[i, j] is 1 if the two hands can be dealt
+    together. Both are 0 for hands which share a card with each other or the board.
+    Raises ValueError if the board is not complete.
+    """
+    def __init__(self, board, hero_range, villain_range):
+        strengths = ranked_board(board).strengths
+        self.key = next(_showdown_keys)
+        self.hero_combos = np.flatnonzero(hero_range.weights)
+        self.villain_combos = np.flatnonzero(villain_range.weights)
+        villain_strengths = strengths[self.villain_combos, np.newaxis]
+        hero_strengths = strengths[self.hero_combos]
+        self.compatible = ((COMBO_MASKS[self.villain_combos, np.newaxis]
+                            & COMBO_MASKS[self.hero_combos]) == 0
+                           & (villain_strengths >= 0)
+                           & (hero_strengths >= 0)).astype(float)
+        self.wins = ((np.sign(villain_strengths - hero_strengths) + 1) / 2
+                     * self.compatible)
+
+    def transposed(self):
+        """
+        Returns the Showdown with the hero and villain hands swapped.
+        """
+        result = Showdown.__new__(Showdown)
+        result.key = next(_showdown_keys)
+        result.hero_combos = self.villain_combos
+        result.villain_combos = self.hero_combos
+        result.compatible = self.compatible.T.copy()
+        result.wins = result.compatible - self.wins.T
+        return result
 
 
 def equity_hand_vs_range(hand, villain_range, board):
     """
-    Calculates the equity of a single hand against a range of hands assuming that there
-    are no cards to come.
+    Calculates the equity of a single hand against a range of hands. If the board is not
+    complete, every runout is enumerated by runout_equity.
     """
-    if not set(hand).isdisjoint(board):
+    if instrument.enabled:
+        instrument.count('equity_hand_vs_range')
+    hero_mask = hand_mask(hand)
+    board_mask = hand_mask(board)
+    if hero_mask & board_mask:
         return 1
     if villain_range.size() == 0:
         return 1
-    hero_hand_value = evaluate_hand(chain(board, hand))
-    lose = 0.0
-    win = 0.0
-    for villain_hand, weight in villain_range.hand_weights.items():
-        if set(hand).isdisjoint(villain_hand) and set(villain_hand).isdisjoint(board):
-            villain_hand_value = evaluate_hand(chain(villain_hand, board))
-            if hero_hand_value > villain_hand_value:
-                win += weight
-            elif hero_hand_value < villain_hand_value:
-                lose += weight
-            else:
-                win += weight / 2
-                lose += weight / 2
+    if len(board) < 5:
+        return runout_equity(hand, villain_range, board).equity
+    strengths = ranked_board(board).strengths
+    hero_hand_value = strengths[combo_index(hand)]
+    live = _live_combos(villain_range, hero_mask | board_mask)
+    villain_hand_values = strengths[live]
+    weights = villain_range.weights[live]
+    tie = weights[villain_hand_values == hero_hand_value].sum() / 2
+    win = weights[villain_hand_values < hero_hand_value].sum() + tie
+    lose = weights[villain_hand_values > hero_hand_value].sum() + tie
     if lose + win == 0:
         return 1
     return win / (lose + win)
 
 
+def equities_vs_range(villain_range, board):
+    """
+    Calculates the equity of every two card hand against a range of hands on a complete
+    board. Returns an array indexed by combo; hands which conflict with the board or have
+    no compatible villain hands have equity 1. Raises ValueError if the board is not
+    complete, since the equities would ignore the cards to come.
+    """
+    if instrument.enabled:
+        instrument.count('equities_vs_range')
+    beaten, tied, compatible = ranked_board(board).showdown_weights(villain_range)
+    equities = np.ones(NUM_COMBOS)
+    # Prefix sums leave rounding error where nothing should remain.
+    contested = compatible > 1e-9 * villain_range.size()
+    equities[contested] = ((beaten[contested] + tied[contested] / 2)
+                           / compatible[contested])
+    return equities
+
+
 def equity_range_vs_range(hero_range, villain_range, board):
     """
-    Calculates the equity of a range of hands against another weighted range of hands
-    assuming that there are no cards to come.
-    """
-    lose = 0.0
-    win = 0.0
-    villain_hands = []
-    for villain_hand, villain_weight in villain_range.hand_weights.items():
-        if set(villain_hand).isdisjoint(board):
-            villain_hands.append((villain_hand,
-                                  villain_weight,
-                                  evaluate_hand(chain(villain_hand, board))))
-    for hero_hand, hero_weight in hero_range.hand_weights.items():
-        if not set(hero_hand).isdisjoint(board):
-            continue
-        hero_hand_value = evaluate_hand(chain(hero_hand, board))
-        for villain_hand, villain_weight, villain_hand_value in villain_hands:
-            if set(hero_hand).isdisjoint(villain_hand):
-                weight = hero_weight * villain_weight
-                if hero_hand_value > villain_hand_value:
-                    win += weight
-                elif hero_hand_value < villain_hand_value:
-                    lose += weight
-                else:
-                    win += weight / 2
-                    lose += weight / 2
-    if lose + win == 0:
+    Calculates the equity of a range of hands against another weighted range of hands.
+    If the board is not complete, every runout is enumerated by runout_equity.
+    """
+    if instrument.enabled:
+        instrument.count('equity_range_vs_range')
+    if len(board) < 5:
+        return runout_equity(hero_range, villain_range, board).equity
+    beaten, tied, compatible = ranked_board(board).showdown_weights(villain_range)
+    win = hero_range.weights @ (beaten + tied / 2)
+    total = hero_range.weights @ compatible
+    if total == 0:
         return 1
-    return win / (lose + win)
+    return win / total
+
+
+RunoutEquity = namedtuple('RunoutEquity', ['equity', 'error', 'samples'])
+
+
+def runout_equity(hero, villain_range, board, tolerance=None, time_limit=None,
+                  batch_size=100, seed=None):
+    """
+    Calculates the equity of a hand or Range against a range of hands on a board of 3 to 5
+    cards, averaging over the cards to come. Returns a RunoutEquity holding the equity,
+    its standard error and the number of runouts evaluated.
+
+    With no tolerance or time_limit every runout is enumerated and the error is 0.
+    Otherwise runouts are sampled without replacement batch_size at a time until the
+    standard error is at most tolerance or time_limit seconds have passed, whichever
+    comes first. Once every runout has been drawn the equity is exact and the error is
+    0, so sampling never costs more than enumerating, and a tolerance of 0 gives the
+    exact equity.
+    """
+    if not isinstance(hero, Range):
+        hero = Range({tuple(hero): 1})
+    board = list(board)
+    board_mask = hand_mask(board)
+    hero_weights = np.where(COMBO_MASKS & board_mask == 0, hero.weights, 0)
+    # A card held by every hero hand cannot come, so runouts holding it are skipped.
+    held = (np.bitwise_and.reduce(COMBO_MASKS[hero_weights != 0])
+            if hero_weights.any() else 0)
+    live = [card for card in DECK if not card.mask & (board_mask | int(held))]
+    to_come = 5 - len(board)
+    if _compatible_weight(hero_weights, villain_range, board_mask) == 0:
+        return RunoutEquity(1, 0, 0)
+    if to_come == 0 or (tolerance is None and time_limit is None):
+        wins, totals = _runout_weights(hero_weights, villain_range, board,
+                                       combinations(live, to_come))
+        return RunoutEquity(float(wins.sum() / totals.sum()), 0, len(wins))
+
+    # There are at most 1176 runouts of a flop, so they are listed and drawn in a
+    # random order.
+    runouts = list(combinations(live, to_come))
+    order = np.random.default_rng(seed).permutation(len(runouts)).tolist()
+    start = time.perf_counter()
+    wins = np.zeros(0)
+    totals = np.zeros(0)
+    while True:
+        batch_wins, batch_totals = _runout_weights(
+            hero_weights, villain_range, board,
+            (runouts[i] for i in order[len(wins):len(wins) + batch_size]))
+        wins = np.concatenate((wins, batch_wins))
+        totals = np.concatenate((totals, batch_totals))
+        equity = wins.sum() / totals.sum() if totals.any() else 1
+        if len(wins) == len(runouts):
+            return RunoutEquity(float(equity), 0, len(wins))
+        # Standard error of the ratio estimate, from the spread of each runout's wins
+        # around what the estimate predicts for it, reduced by the share of the runouts
+        # already drawn.
+        if len(wins) > 1 and totals.any():
+            residuals = wins - equity * totals
+            error = (np.sqrt(residuals @ residuals / (len(wins) - 1) / len(wins)
+                             * (1 - len(wins) / len(runouts)))
+                     / totals.mean())
+        else:
+            error = np.inf
+        elapsed = time.perf_counter() - start
+        if ((tolerance is not None and error <= tolerance)
+                or (time_limit is not None and elapsed >= time_limit)):
+            return RunoutEquity(float(equity), float(error), len(wins))
+
+
+def _compatible_weight(hero_weights, villain_range, board_mask):
+    """
+    Returns the total weight of the pairs of hands from hero_weights and villain_range
+    which share no cards with each other or the board.
+    """
+    villain_weights = np.where(COMBO_MASKS & board_mask == 0, villain_range.weights, 0)
+    card_weights = np.bincount(COMBO_CARDS.ravel(), np.repeat(villain_weights, 2),
+                               minlength=52)
+    compatible = (villain_weights.sum() - card_weights[COMBO_CARDS].sum(axis=1)
+                  + villain_weights)
+    return hero_weights @ compatible
+
+
+def _runout_weights(hero_weights, villain_range, board, runouts):
+    """
+    Returns two arrays holding, for each runout, the weight of the pairs of hero and
+    villain hands which can be dealt with it that the hero wins, counting ties as half,
+    and the weight of all such pairs.
+    """
+    wins = []
+    totals = []
+    for runout in runouts:
+        if instrument.enabled:
+            instrument.count('runouts')
+        beaten, tied, compatible = RankedBoard(board + list(runout)).showdown_weights(
+            villain_range)
+        wins.append(hero_weights @ (beaten + tied / 2))
+        totals.append(hero_weights @ compatible)
+    return np.array(wins), np.array(totals)
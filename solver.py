@@ -1,80 +1,699 @@
+import asyncio
+from collections import namedtuple
+import copy
+import os
+import time
+import instrument
 import strategy
+import parallel
 import poker
-from scipy.optimize import minimize
+from scipy.optimize import OptimizeResult, linprog
+from scipy import sparse
 import numpy as np
 
+# A strategy reached during a solve, as yielded by Solver.iter_strategies. strategy
+# holds CFRSolver's average strategy at each decision, as from get_average_strategy.
+SolveStep = namedtuple('SolveStep', ['iteration', 'x', 'fun', 'elapsed', 'strategy'],
+                       defaults=(None,))
+
 
 class Solver:
+    """
+    Finds the hero strategy which minimises the villain's best response EV. Unless
+    reduce_suits is False, hands which suit permutations fixing the board and both ranges
+    move into each other are solved as one (see poker.SuitIsomorphism), and the result
+    is shared back out between them, so the problem is smaller on boards and ranges with
+    such symmetries. evaluate_strategy and results always use the full set of hands.
+
+    The villain's best response EV is piecewise linear in the hero's plan weights, so
+    rather than minimising it directly the solve is written as a linear program, with a
+    bound on the villain's EV for each villain hand held above the EV of every counter
+    plan, and solved exactly with HiGHS (see _linear_program).
+
+    If prune_plans is True, plans which a hand can drop without losing anything
+    against any villain strategy (see StrategyTree.get_dominated_plans) are fixed at 0
+    and left out of the optimisation, such as folding the nuts or calling with a hand
+    which cannot win.
+
+    cache_size bounds the number of showdown results kept by the strategy tree's
+    equity_cache; each holds two rows of a float for every villain hand.
+    """
+    # Whether trees with several bet sizes, for which plans are not defined, can be
+    # solved. Subclasses which do not work with plans may set it.
+    several_bet_sizes = False
+
     def __init__(self, board, hero_range, villain_range, hero='ip', bet_size=1,
-                 stack_size=1, starting_pot_size=1):
+                 stack_size=1, starting_pot_size=1, workers=None, reduce_suits=True,
+                 prune_plans=False, cache_size=1024):
         self.hero = hero
+        self.prune_plans = prune_plans
+        self.cache_size = cache_size
+        self.workers = workers
+        self.parallel_best_response = None
         self.villain = 'ip' if hero == 'oop' else 'oop'
         self.hero_range = hero_range
         self.villain_range = villain_range
-        self.strategy_tree = strategy.StrategyTree(board, starting_pot_size, stack_size,
-                                                   bet_size)
+        self.showdown = poker.Showdown(board, hero_range, villain_range)
+        self.hero_combos = self.showdown.hero_combos
+        if reduce_suits:
+            self.isomorphism = poker.SuitIsomorphism(board, hero_range, villain_range)
+            self.solve_hero_range = self.isomorphism.reduce_range(hero_range)
+            self.solve_villain_range = self.isomorphism.reduce_range(villain_range)
+            self.solve_showdown = self.isomorphism.reduce_showdown(self.showdown)
+        else:
+            self.isomorphism = None
+            self.solve_hero_range = hero_range
+            self.solve_villain_range = villain_range
+            self.solve_showdown = self.showdown
+        self._set_tree(strategy.StrategyTree(board, starting_pot_size, stack_size,
+                                             bet_size, cache_size))
 
-    def create_optimal_strategy(self):
-        plans = self.strategy_tree.get_plans(self.hero)
-        num_plans = len(self.strategy_tree.get_plans(self.hero))
-        num_hands = len(self.hero_range.hand_weights)
-        num_args = num_plans * num_hands
-        initial_guess = np.zeros(num_args)
-        constraints = []
-
-        def make_sum_constraint(num_hands, hand_num, desired_total, start=None,
-                                stop=None):
-            def constraint(arr):
-                nonlocal start
-                nonlocal stop
-                if start is None:
-                    start = 0
-                if stop is None:
-                    stop = len(arr)
-                total = 0
-                for i in range(start, stop):
-                    if i % num_hands == hand_num:
-                        total += arr[i]
-                return desired_total - total
-            return constraint
+    def _set_tree(self, tree):
+        self.strategy_tree = tree
+        # Which of the nodes the villain's best response depends on each hero plan
+        # passes through, for turning node gradients into plan gradients. Plans are only
+        # defined for a single bet size.
+        if len(tree.bet_sizes) == 1:
+            nodes, branches = tree.get_counter_plans(self.villain)
+            self.plan_counter_incidence = tree.get_plan_incidence(self.hero)[:, nodes]
+            # Which hero plans each reduced hero hand leaves out of the optimisation.
+            showdown = self.solve_showdown
+            if self.prune_plans:
+                self.dominated = tree.get_dominated_plans(
+                    self.hero, showdown,
+                    self.solve_villain_range.weights[showdown.villain_combos])
+            else:
+                self.dominated = np.zeros((len(tree.get_plans(self.hero)),
+                                           len(showdown.hero_combos)), dtype=bool)
+        elif self.several_bet_sizes:
+            self.plan_counter_incidence = None
+            self.dominated = None
+        else:
+            raise ValueError('{} needs a single bet size; use CFRSolver for several'
+                             .format(type(self).__name__))
 
-        if self.hero == 'oop':
-            for i, weight in enumerate(self.hero_range.hand_weights.values()):
-                for j in range(num_plans):
-                    initial_guess[i + j * num_hands] = weight / num_plans
-                constraints.append({'type': 'eq',
-                                    'fun': make_sum_constraint(num_hands, i, weight)})
-        elif self.hero == 'ip':
-            num_bet_plans = len([p for p in plans if p[0] == 'r'])
-            for i, weight in enumerate(self.hero_range.hand_weights.values()):
-                for j in range(num_bet_plans):
-                    initial_guess[i + j * num_hands] = weight / num_bet_plans
-                for j in range(num_bet_plans, num_plans):
-                    initial_guess[i + j * num_hands] = (weight
-                                                        / (num_plans - num_bet_plans))
-                constraints.append(
-                    {'type': 'eq',
-                     'fun': make_sum_constraint(num_hands, i, weight, 0,
-                                                num_bet_plans * num_hands)})
-                constraints.append(
-                    {'type': 'eq',
-                     'fun': make_sum_constraint(num_hands, i, weight,
-                                                num_bet_plans * num_hands, num_args)})
-
-        bounds = [(0, None) for _ in range(num_args)]
-        return minimize(self.evaluate_strategy, initial_guess, method='SLSQP',
-                        bounds=bounds, constraints=constraints)
-
-    def evaluate_strategy(self, arr):
-        self.strategy_tree.clear_ranges()
+    def resized(self, bet_size, stack_size, starting_pot_size=None, cache_size=None):
+        """
+        Returns a Solver for the same board and ranges with a different bet size, stack
+        size or starting pot size, which shares this one's showdown and suit reduction
+        rather than building them again. Its tree's cache size is this one's unless
+        cache_size is given.
+        """
+        if starting_pot_size is None:
+            starting_pot_size = self.strategy_tree.starting_pot_size
+        resized = copy.copy(self)
+        resized.parallel_best_response = None
+        if cache_size is not None:
+            resized.cache_size = cache_size
+        resized._set_tree(strategy.StrategyTree(self.strategy_tree.board,
+                                                starting_pot_size, stack_size, bet_size,
+                                                resized.cache_size))
+        return resized
+
+    def map_strategy(self, other, arr):
+        """
+        Takes a strategy arr found by another Solver for the same ranges, in the layout
+        used by evaluate_strategy, and returns a strategy for this solver's plans. Each
+        plan takes the weights of the other solver's plan which shares the longest
+        start with it, split equally between all the plans taking them.
+        """
+        old_plans = other.strategy_tree.get_plans(self.hero)
+        arr = np.reshape(arr, (len(old_plans), -1))
+        sources = [max(range(len(old_plans)),
+                       key=lambda i: len(os.path.commonprefix((old_plans[i], plan))))
+                   for plan in self.strategy_tree.get_plans(self.hero)]
+        shares = np.bincount(sources, minlength=len(old_plans))
+        return (arr[sources] / shares[sources, np.newaxis]).ravel()
+
+    def create_optimal_strategy(self, callback=None):
+        """
+        Solves for the hero strategy and returns scipy's OptimizeResult, with x and jac
+        in the layout used by evaluate_strategy. If callback is given it is called once
+        the program is solved with the number of iterations HiGHS took and
+        instrument.report(). When instrumentation is enabled the result's report holds
+        the report for the solve.
+        """
+        with instrument.timer('solve'):
+            result = self._solve(callback)
+        if instrument.enabled:
+            result.report = instrument.report()
+        return result
+
+    def _solve(self, callback, time_limit=None):
+        """
+        Solves the linear program from _linear_program with HiGHS and returns its result
+        for every hero hand. If time_limit seconds pass first, the result's x is None.
+        Only the weights of plans which are not dominated are solved for.
+        """
+        num_args = self.dominated.size
+        live = np.flatnonzero(~self.dominated.ravel())
+        instrument.count('pruned_plan_weights', num_args - len(live))
+        objective, bound_matrix, sum_matrix, totals = self._linear_program(live)
+        bounds = [(0, None)] * len(live) + [(None, None)] * (len(objective) - len(live))
+        options = {} if time_limit is None else {'time_limit': max(time_limit, 0)}
+        with instrument.timer('linear_program'):
+            result = linprog(objective, A_ub=bound_matrix,
+                             b_ub=np.zeros(bound_matrix.shape[0]), A_eq=sum_matrix,
+                             b_eq=totals, bounds=bounds, method='highs', options=options)
+        instrument.count('solver_iterations', result.nit)
+        if callback is not None:
+            callback(result.nit, instrument.report())
+        if result.x is None:
+            return result
+        x = np.zeros(num_args)
+        x[live] = result.x[:len(live)]
+        # Rescaled so that rounding in the solve leaves each hand's plans summing exactly.
+        x = self._feasible(x)
+        if self.workers is not None and self.workers > 1:
+            self.parallel_best_response = parallel.ParallelBestResponse(
+                self.strategy_tree, self.villain, self.solve_villain_range,
+                self.solve_showdown, self.workers)
+        try:
+            result.fun, result.jac = self._evaluate(x, self.solve_showdown,
+                                                    self.solve_villain_range, True)
+        finally:
+            if self.parallel_best_response is not None:
+                self.parallel_best_response.close()
+                self.parallel_best_response = None
+        result.x = x
+        if self.isomorphism is not None:
+            result.x = self.expand_strategy(result.x)
+            result.fun, result.jac = self.evaluate_strategy(result.x, gradient=True)
+        return result
+
+    def _linear_program(self, live):
+        """
+        Returns the solve as a linear program (objective, bound matrix, sum matrix,
+        totals) over the live plan weights, numbered as in the layout used by _evaluate,
+        followed by a bound on the villain's EV for each villain hand in each branch of
+        get_counter_plans, or overall if the villain is oop. Every villain counter plan
+        gives a row of the bound matrix for each villain hand, which is at most 0 when
+        the plan's EV is at most the bound. The villain's best response EV is piecewise
+        linear in the plan weights, but the weighted sum of the bounds, which the
+        objective holds, is linear and at the optimum equals it. The sum matrix times
+        the variables must equal totals, so that each hand's plans in each group sum to
+        the hand's weight.
+        """
+        tree = self.strategy_tree
+        showdown = self.solve_showdown
+        num_hands = len(showdown.hero_combos)
+        num_villain_hands = len(showdown.villain_combos)
+        wins = sparse.csr_matrix(showdown.wins)
+        compatible = sparse.csr_matrix(showdown.compatible)
+        nodes, branches = tree.get_counter_plans(self.villain)
+        # The ip villain responds to a bet and to a check separately, and adds their EVs.
+        num_bounds = len(branches) if self.villain == 'ip' else 1
+        bound_blocks = [-sparse.identity(num_villain_hands, format='csr') if i == bound
+                        else sparse.csr_matrix((num_villain_hands, num_villain_hands))
+                        for bound in range(num_bounds) for i in range(num_bounds)]
+        rows = []
+        for branch_num, plans in enumerate(branches):
+            bound = branch_num if num_bounds > 1 else 0
+            for plan, terms in plans:
+                positions, win_coefs, size_coefs = map(np.array, zip(*terms))
+                incidence = self.plan_counter_incidence[:, positions]
+                plan_win_coefs = incidence @ win_coefs
+                plan_size_coefs = incidence @ size_coefs
+                rows.append(sparse.hstack(
+                    [win_coef * wins + size_coef * compatible
+                     for win_coef, size_coef in zip(plan_win_coefs, plan_size_coefs)]
+                    + bound_blocks[bound * num_bounds:(bound + 1) * num_bounds]))
+        num_args = self.dominated.size
+        columns = np.concatenate([live,
+                                  num_args + np.arange(num_bounds * num_villain_hands)])
+        bound_matrix = sparse.vstack(rows, format='csc')[:, columns]
+
+        groups = self._plan_groups()
+        num_groups = groups.max() + 1
+        plan_nums, hand_nums = np.divmod(live, num_hands)
+        sum_matrix = sparse.csr_matrix((np.ones(len(live)),
+                                        (groups[plan_nums] * num_hands + hand_nums,
+                                         np.arange(len(live)))),
+                                       shape=(num_groups * num_hands, len(columns)))
+        weights = self.solve_hero_range.weights[showdown.hero_combos]
+        villain_weights = self.solve_villain_range.weights[showdown.villain_combos]
+        objective = np.concatenate([np.zeros(len(live)),
+                                    np.tile(villain_weights, num_bounds)])
+        return objective, bound_matrix, sum_matrix, np.tile(weights, num_groups)
+
+    def _plan_groups(self):
+        """
+        Returns the group of each hero plan. Each hand's plans in a group must sum to the
+        hand's weight: there is one group for oop, and for ip one for facing a bet and
+        one for facing a check.
+        """
         plans = self.strategy_tree.get_plans(self.hero)
-        idx = 0
-
-        for plan in plans:
-            plan_range = poker.Range()
-            for hand in self.hero_range.hand_weights:
-                plan_range.hand_weights[hand] = arr[idx]
-                idx += 1
-            self.strategy_tree.modify_nodes_by_plan(plan, plan_range)
-        return self.strategy_tree.create_counter_strategy(self.villain,
-                                                          self.villain_range.hand_weights)
+        if self.hero == 'oop':
+            return np.zeros(len(plans), dtype=int)
+        return np.array([0 if plan[0] == 'r' else 1 for plan in plans])
+
+    def _feasible(self, arr):
+        """
+        Returns a strategy for the reduced hands, in the layout used by _evaluate, which
+        is arr with negative weights and dominated plans removed and each hand's plans
+        rescaled to have the right total in each group. Hands with no weight on a group
+        play its plans which are not dominated equally.
+        """
+        groups = self._plan_groups()
+        num_groups = groups.max() + 1
+        weights = self.solve_hero_range.weights[self.solve_showdown.hero_combos]
+        live = ~self.dominated
+        arr = np.maximum(np.reshape(arr, (len(groups), -1)), 0) * live
+        sums = np.array([arr[groups == group].sum(axis=0)
+                         for group in range(num_groups)])[groups]
+        counts = np.array([live[groups == group].sum(axis=0)
+                           for group in range(num_groups)])[groups]
+        uniform = weights * live / counts
+        scale = weights / np.where(sums > 0, sums, 1)
+        return np.where(sums > 0, arr * scale, uniform).ravel()
+
+    def iter_strategies(self, initial_guess=None, time_limit=None):
+        """
+        Solves as create_optimal_strategy does, but as an iterator of SolveSteps, each
+        holding the iteration number, the hero strategy, the villain's best response EV
+        against it and the seconds since the start, in the same form as CFRSolver's. The
+        strategy is in the layout used by evaluate_strategy. The linear program is solved
+        in one go, so there is a single step, iteration 1, for the optimal strategy. For
+        example
+
+            best = min(problem.iter_strategies(time_limit=.5), key=lambda s: s.fun)
+
+        gives the best strategy found in about half a second. HiGHS stops once
+        time_limit seconds have passed, if given, and if it has not solved the program
+        by then the step has iteration 0 and holds initial_guess instead, such as one
+        from map_strategy, rescaled so that each hand's plans have the right total. By
+        default every hand plays its plans equally.
+        """
+        start = time.perf_counter()
+        with instrument.timer('solve'):
+            result = self._solve(None, time_limit)
+        if result.x is not None:
+            yield SolveStep(1, result.x, result.fun, time.perf_counter() - start)
+            return
+        if initial_guess is None:
+            x = self._feasible(np.zeros(self.dominated.size))
+        else:
+            guess = np.reshape(initial_guess, (len(self.dominated), -1))
+            if self.isomorphism is not None:
+                guess = self.isomorphism.reduce(guess, self.hero_combos)
+            x = self._feasible(guess)
+        if self.isomorphism is not None:
+            x = self.expand_strategy(x)
+        yield SolveStep(0, x, self.evaluate_strategy(x), time.perf_counter() - start)
+
+    def evaluate_strategy(self, arr, gradient=False):
+        """
+        Returns the villain's best response EV against the hero strategy arr, which
+        holds each hero plan's weight on each hero hand. If gradient is True, returns a
+        tuple of the EV and its gradient with respect to arr instead.
+        """
+        return self._evaluate(arr, self.showdown, self.villain_range, gradient)
+
+    def expand_strategy(self, arr):
+        """
+        Turns a strategy for the reduced hands solved for into one for every hero hand,
+        sharing each reduced hand's plan weights equally between the hands it stands for.
+        """
+        num_hands = len(self.solve_showdown.hero_combos)
+        return self.isomorphism.expand(np.reshape(arr, (-1, num_hands)),
+                                       self.solve_showdown.hero_combos,
+                                       self.hero_combos).ravel()
+
+    def _evaluate(self, arr, showdown, villain_range, gradient):
+        instrument.count('objective_evaluations')
+        with instrument.timer('objective'):
+            return self._evaluate_strategy(arr, showdown, villain_range, gradient)
+
+    def _evaluate_strategy(self, arr, showdown, villain_range, gradient):
+        num_hands = len(showdown.hero_combos)
+        self.strategy_tree.set_strategy(self.hero, np.reshape(arr, (-1, num_hands)),
+                                        showdown.hero_combos)
+        if self.parallel_best_response is not None:
+            result = self.parallel_best_response(gradient)
+        else:
+            result = self.strategy_tree.create_counter_strategy(
+                self.villain, villain_range, showdown, gradient)
+        if not gradient:
+            return result
+        total_ev, node_gradients = result
+        return total_ev, (self.plan_counter_incidence @ node_gradients).ravel()
+
+
+def sweep(board, hero_range, villain_range, sizes, hero='ip', starting_pot_size=1,
+          method='lp', iterations=1000, **options):
+    """
+    Solves a board for each pair (bet_size, stack_size) in sizes, in order, and returns
+    a list of the results. The showdown and suit reduction are built once. method is
+    'lp' for Solver, which solves each linear program from scratch, or 'cfr' for
+    CFRSolver, which runs iterations iterations starting from the previous regrets, so
+    neighbouring sizes should be listed next to each other. options are passed on to
+    the solver.
+    """
+    solver_class = CFRSolver if method == 'cfr' else Solver
+    results = []
+    problem = None
+    for bet_size, stack_size in sizes:
+        previous = problem
+        if previous is None:
+            problem = solver_class(board, hero_range, villain_range, hero, bet_size,
+                                   stack_size, starting_pot_size, **options)
+        else:
+            problem = previous.resized(bet_size, stack_size)
+        if method == 'cfr':
+            if previous is not None:
+                problem.warm_start(previous)
+            results.append(problem.create_optimal_strategy(iterations))
+        else:
+            results.append(problem.create_optimal_strategy())
+    return results
+
+
+async def iter_strategies_async(problem, *args, **kwargs):
+    """
+    Yields the steps of problem.iter_strategies(*args, **kwargs) from an asynchronous
+    generator, computing each in the event loop's default executor. Leaving the loop
+    early, or cancelling the task running it, stops the solve in the executor too; if a
+    step is being computed it is finished in the background first.
+
+    The solve runs in a thread of this process. HiGHS releases the GIL while it solves,
+    but building the linear program and CFR's tree walks do not, so the event loop can
+    still be paused briefly; solves which must not pause it at all should run in
+    another process, as batch does.
+    """
+    loop = asyncio.get_running_loop()
+    steps = problem.iter_strategies(*args, **kwargs)
+    pending = None
+
+    def close(future=None):
+        # The iterators start no threads of their own, so closing one is quick and can be
+        # done on the loop's thread, even while the loop is shutting down its executor.
+        steps.close()
+
+    try:
+        while True:
+            pending = loop.run_in_executor(None, next, steps, None)
+            # Shielded so that cancelling the task leaves pending running to the end.
+            step = await asyncio.shield(pending)
+            if step is None:
+                return
+            yield step
+    finally:
+        if pending is not None and not pending.done():
+            pending.add_done_callback(close)
+        else:
+            close()
+
+
+class CFRSolver(Solver):
+    """
+    Solves for an equilibrium with CFR+. Rather than optimising the hero's plans
+    directly, both players' strategies are improved in turn by regret matching at every
+    decision node of the strategy tree, and the hero's average strategy converges to an
+    optimal one. Regrets and strategy sums are kept in arrays with a row for each action
+    at a node and a column for each of the acting player's hands. Unlike Solver it can
+    use several bet sizes, passed as a sequence. Each iteration walks every node, so the
+    first one builds the whole tree.
+
+    It takes no workers or prune_plans: its tree walks run in this process, and every
+    action keeps a strategy, so no plans are left out.
+    """
+    several_bet_sizes = True
+
+    def __init__(self, board, hero_range, villain_range, hero='ip', bet_size=1,
+                 stack_size=1, starting_pot_size=1, reduce_suits=True, cache_size=1024):
+        super().__init__(board, hero_range, villain_range, hero, bet_size, stack_size,
+                         starting_pot_size, None, reduce_suits, False, cache_size)
+        showdown = self.solve_showdown
+        self.weights = {
+            self.hero: self.solve_hero_range.weights[showdown.hero_combos],
+            self.villain: self.solve_villain_range.weights[showdown.villain_combos]}
+        self.decisions = {}
+        self.exploitability = []
+
+    def create_optimal_strategy(self, iterations=1000, callback=None,
+                                target_exploitability=None):
+        """
+        Runs iterations of CFR+ and returns an OptimizeResult whose x holds the hero's
+        average strategy in the same layout as Solver's, whose fun is the villain's best
+        response EV against it, and whose exploitability lists the exploitability of the
+        average strategies after each iteration. If target_exploitability is given, stops
+        as soon as the exploitability is at most the target. callback and the result's
+        report are as for Solver. Plans are only defined for a single bet size, so with
+        several x is None, and the result's strategy holds the hero's average strategy
+        at each decision as given by get_average_strategy.
+        """
+        with instrument.timer('solve'):
+            for iteration in range(1, iterations + 1):
+                self._iterate(iteration)
+                if callback is not None:
+                    callback(iteration, instrument.report())
+                if (target_exploitability is not None
+                        and self.exploitability[-1] <= target_exploitability):
+                    break
+            if len(self.strategy_tree.bet_sizes) == 1:
+                x = self.get_plan_strategy()
+                fun = self.evaluate_strategy(x)
+            else:
+                x = None
+                fun = self._best_response_value(self.villain)
+            result = OptimizeResult(x=x, fun=fun, nit=iteration, success=True,
+                                    exploitability=self.exploitability,
+                                    strategy=self.get_average_strategy(self.hero))
+        if instrument.enabled:
+            result.report = instrument.report()
+        return result
+
+    def iter_strategies(self, iterations=1000, time_limit=None):
+        """
+        Runs iterations of CFR+ as create_optimal_strategy does, yielding a SolveStep as
+        described for Solver after each one, with the hero's average strategy and the
+        villain's best response EV against it. x is None with several bet sizes, and
+        each step's strategy holds the average strategy at each decision, as given by
+        get_average_strategy. Stops once time_limit seconds have passed, if given.
+        """
+        start = time.perf_counter()
+        for iteration in range(1, iterations + 1):
+            self._iterate(iteration)
+            if len(self.strategy_tree.bet_sizes) == 1:
+                x = self.get_plan_strategy()
+            else:
+                x = None
+            step = SolveStep(iteration, x, self._best_response_value(self.villain),
+                             time.perf_counter() - start,
+                             self.get_average_strategy(self.hero))
+            yield step
+            if time_limit is not None and step.elapsed >= time_limit:
+                return
+
+    def _iterate(self, iteration):
+        with instrument.timer('cfr_iteration'):
+            for player in ('oop', 'ip'):
+                reaches = dict(self.weights)
+                self._cfr(self.strategy_tree.root, player, reaches, iteration)
+        with instrument.timer('exploitability'):
+            self.exploitability.append(float(self.get_exploitability()))
+        instrument.count('solver_iterations')
+
+    def resized(self, bet_size, stack_size, starting_pot_size=None, cache_size=None):
+        resized = super().resized(bet_size, stack_size, starting_pot_size, cache_size)
+        resized.decisions = {}
+        resized.exploitability = []
+        return resized
+
+    def warm_start(self, other):
+        """
+        Starts from the regrets of another CFRSolver for the same ranges, such as one for
+        a different bet size, at each decision which has the same actions leading to it
+        and the same actions available. The strategy sums are not copied, since an
+        average over the other tree's iterations would take long to wash out. Only the
+        other solver's decisions are visited, and only the nodes on the way to them are
+        built in this tree.
+        """
+        for other_node, other_decision in other.decisions.items():
+            if other_decision is None:
+                continue
+            node = self.strategy_tree.node(other.strategy_tree.path(other_node))
+            if node < 0:
+                continue
+            decision = self._decision(node)
+            if (decision is not None
+                    and other_decision['actions'] == decision['actions']):
+                decision['regrets'] = other_decision['regrets'].copy()
+
+    def get_exploitability(self):
+        """
+        Returns how much the two players could gain in total by switching to best
+        responses against each other's average strategies. This walks the tree once per
+        player with every hand at once; StrategyTree.exploitability gives the same result
+        from the strategies as plan weights.
+        """
+        total = self._best_response_value('oop') + self._best_response_value('ip')
+        compatible_weight = (self.weights[self.villain] @ self.solve_showdown.compatible
+                             @ self.weights[self.hero])
+        return total - self.strategy_tree.starting_pot_size * compatible_weight
+
+    def _best_response_value(self, player):
+        """
+        Returns the EV of player's best response to the other player's average strategy.
+        """
+        values = self._best_response(self.strategy_tree.root, player,
+                                     self.weights[self._opponent(player)])
+        return self.weights[player] @ values
+
+    def get_plan_strategy(self):
+        """
+        Returns the hero's average strategy as the weight each hero plan puts on each
+        hero hand, in the layout used by evaluate_strategy.
+        """
+        x = self.get_plan_weights(self.hero).ravel()
+        if self.isomorphism is not None:
+            x = self.expand_strategy(x)
+        return x
+
+    def get_average_strategy(self, player):
+        """
+        Returns player's average strategy at each of player's decisions reached so far,
+        which works for any number of bet sizes. It is a dictionary from the path of
+        each decision, as given by StrategyTree.path, to a dictionary from each action
+        to the frequency with which each of player's hands takes it, over the hands of
+        showdown.hero_combos or showdown.villain_combos.
+        """
+        if player == self.hero:
+            combos = self.showdown.hero_combos
+            solve_combos = self.solve_showdown.hero_combos
+        else:
+            combos = self.showdown.villain_combos
+            solve_combos = self.solve_showdown.villain_combos
+        # Each hand plays as the representative of its class it was solved as.
+        if self.isomorphism is not None:
+            positions = np.searchsorted(solve_combos, self.isomorphism.classes[combos])
+        else:
+            positions = np.arange(len(combos))
+        strategies = {}
+        for node, decision in sorted(self.decisions.items()):
+            if decision is None or self._actor(node) != player:
+                continue
+            frequencies = self._normalize(decision['strategy_sum'])[:, positions]
+            strategies[self.strategy_tree.path(node)] = dict(zip(decision['actions'],
+                                                                 frequencies))
+        return strategies
+
+    def get_plan_weights(self, player):
+        """
+        Returns player's average strategy as an array with a row for each of player's
+        plans, in the order given by get_plans, holding its weight on each of player's
+        hands in solve_showdown.
+        """
+        tree = self.strategy_tree
+        plan_weights = []
+        for plan in tree.get_plans(player):
+            weights = self.weights[player].copy()
+            node = tree.root
+            for action in plan:
+                if self._actor(node) == player:
+                    decision = self._decision(node)
+                    strategy = self._normalize(decision['strategy_sum'])
+                    weights *= strategy[decision['actions'].index(action)]
+                node = tree.child(node, action)
+            plan_weights.append(weights)
+        return np.array(plan_weights)
+
+    def _cfr(self, node, player, reaches, iteration):
+        """
+        Returns the counterfactual value of node to each of player's hands, updating
+        player's regrets and strategy sums below it.
+        """
+        decision = self._decision(node)
+        if decision is None:
+            return self._terminal_values(node, player, reaches[self._opponent(player)])
+        actor = self._actor(node)
+        strategy = self._normalize(decision['regrets'])
+        values = []
+        for child, action_strategy in zip(decision['children'], strategy):
+            child_reaches = dict(reaches)
+            child_reaches[actor] = reaches[actor] * action_strategy
+            values.append(self._cfr(child, player, child_reaches, iteration))
+        values = np.array(values)
+        if actor != player:
+            return values.sum(axis=0)
+        node_values = (strategy * values).sum(axis=0)
+        decision['regrets'] = np.maximum(decision['regrets'] + values - node_values, 0)
+        decision['strategy_sum'] += iteration * reaches[actor] * strategy
+        return node_values
+
+    def _best_response(self, node, player, opponent_reach):
+        """
+        Returns the value of node to each of player's hands when player best responds
+        to the opponent's average strategy.
+        """
+        decision = self._decision(node)
+        if decision is None:
+            return self._terminal_values(node, player, opponent_reach)
+        if self._actor(node) == player:
+            return np.max([self._best_response(child, player, opponent_reach)
+                           for child in decision['children']], axis=0)
+        strategy = self._normalize(decision['strategy_sum'])
+        return np.sum([self._best_response(child, player,
+                                           opponent_reach * action_strategy)
+                       for child, action_strategy in zip(decision['children'], strategy)],
+                      axis=0)
+
+    def _terminal_values(self, node, player, opponent_reach):
+        """
+        Returns the value of a terminal node to each of player's hands. The villain's
+        value follows StrategyTree.create_counter_strategy and the hero gets the rest of
+        the starting pot.
+        """
+        tree = self.strategy_tree
+        pot_size = tree.pot_sizes[node]
+        if tree.action(node) == 'f':
+            win_coef = 0
+            if self._actor(tree.parents[node]) == self.villain:
+                size_coef = -tree.amount_lost(pot_size)
+            else:
+                size_coef = tree.amount_gained(pot_size)
+        else:
+            win_coef = pot_size
+            size_coef = -tree.amount_lost(pot_size)
+        showdown = self.solve_showdown
+        if player == self.villain:
+            return (win_coef * (showdown.wins @ opponent_reach)
+                    + size_coef * (showdown.compatible @ opponent_reach))
+        return ((tree.starting_pot_size - size_coef)
+                * (opponent_reach @ showdown.compatible)
+                - win_coef * (opponent_reach @ showdown.wins))
+
+    def _decision(self, node):
+        """
+        Returns the actions, children, regrets and strategy sums for the decision at
+        node, or None if node is terminal.
+        """
+        if node not in self.decisions:
+            tree = self.strategy_tree
+            actions = [action for action in tree.actions if tree.child(node, action) >= 0]
+            if actions:
+                shape = (len(actions), len(self.weights[self._actor(node)]))
+                self.decisions[node] = {
+                    'actions': actions,
+                    'children': [tree.child(node, action) for action in actions],
+                    'regrets': np.zeros(shape),
+                    'strategy_sum': np.zeros(shape)}
+            else:
+                self.decisions[node] = None
+        return self.decisions[node]
+
+    def _actor(self, node):
+        return 'oop' if self.strategy_tree.depths[node] % 2 == 0 else 'ip'
+
+    @staticmethod
+    def _opponent(player):
+        return 'ip' if player == 'oop' else 'oop'
+
+    @staticmethod
+    def _normalize(totals):
+        """
+        Turns nonnegative per-action totals into a strategy, playing uniformly where all
+        of a hand's totals are zero.
+        """
+        sums = totals.sum(axis=0)
+        return np.where(sums > 0, totals / np.where(sums > 0, sums, 1), 1 / len(totals))
@@ -0,0 +1,240 @@
+"""
+A file of solved strategies which can be looked up one hand at a time. Solutions are
+keyed on the board, both ranges, the hero and the tree's sizes, and each holds the
+frequency with which each hero hand plays each of the hero's plans: its plan weight
+divided by the hand's weight, so that each hand's plans sum to 1 in each group.
+
+The file is written by save in the format of tables, with the frequencies of every
+solution in one array, and is opened with numpy.memmap without reading it through, so
+looking up a hand only reads the pages holding that solution's index entry and that
+hand's frequencies:
+
+    key = store.solution_key(board, hero_range, villain_range, 'ip', .5, 1)
+    strategies = store.StrategyStore('strategies.bin')
+    strategies.frequencies(key, poker.make_hand('Ac Ad'))
+
+Run this module to build a file from the results written by batch, giving the ranges
+they were solved for:
+
+    python store.py strategies.bin results.jsonl \
+        --hero-range "QcQd KcKd AcAd" --villain-range "QcQd KcKd AcAd"
+"""
+import argparse
+import hashlib
+import json
+import numpy as np
+import poker
+import strategy
+import tables
+
+MAGIC = b'PKRSTRAT'
+STORE_VERSION = 1
+
+
+def solution_key(board, hero_range, villain_range, hero='ip', bet_size=1, stack_size=1,
+                 starting_pot_size=1):
+    """
+    Returns the 16 byte key of the solution for a board, a pair of ranges, the hero and
+    the sizes the tree was built with. bet_size may be a sequence of bet sizes.
+    """
+    board = poker.make_hand(board) if isinstance(board, str) else list(board)
+    bet_sizes = tuple(bet_size) if np.iterable(bet_size) else (bet_size,)
+    # The board's cards in deck order, as batch.format_board writes them.
+    board_text = ' '.join(str(card)
+                          for card in sorted(board, key=lambda card: card.index))
+    description = json.dumps([board_text, hero,
+                              strategy.fingerprint(hero_range.weights).hex(),
+                              strategy.fingerprint(villain_range.weights).hex(),
+                              [float(size) for size in bet_sizes], float(stack_size),
+                              float(starting_pot_size)])
+    return hashlib.blake2b(description.encode(), digest_size=16).digest()
+
+
+def solver_solution(problem, result):
+    """
+    Returns the solution found by a Solver or CFRSolver as a tuple (key, plans, combos,
+    frequencies, value) ready to be passed to save.
+    """
+    tree = problem.strategy_tree
+    key = solution_key(tree.board, problem.hero_range, problem.villain_range,
+                       problem.hero, tree.bet_sizes, tree.stack_size,
+                       tree.starting_pot_size)
+    plans = tree.get_plans(problem.hero)
+    weights = np.reshape(result.x, (len(plans), -1))
+    frequencies = weights / problem.hero_range.weights[problem.hero_combos]
+    return key, plans, problem.hero_combos, frequencies, float(result.fun)
+
+
+def batch_solution(record, hero_range, villain_range):
+    """
+    Returns the solution in a result written by batch, for the given ranges, as a tuple
+    ready to be passed to save.
+    """
+    key = solution_key(record['board'], hero_range, villain_range, record['hero'],
+                       record['bet_size'], record['stack_size'],
+                       record['starting_pot_size'])
+    combos = np.array([poker.combo_index((poker.Card.from_str(hand[:2]),
+                                          poker.Card.from_str(hand[2:])))
+                       for hand in record['hands']], dtype=int)
+    frequencies = np.array(record['strategy']) / hero_range.weights[combos]
+    return key, record['plans'], combos, frequencies, record['value']
+
+
+def _key_words(key):
+    return np.frombuffer(key, dtype='<u8')
+
+
+def save(path, solutions, dtype=np.float32):
+    """
+    Writes solutions, given as tuples (key, plans, combos, frequencies, value), to a
+    file at path, replacing any existing file once the new one is complete. plans lists
+    the hero's plans and combos the combo index of each hero hand, and frequencies has a
+    row for each plan and a column for each hand. Frequencies are stored as dtype, such
+    as numpy.float16 to halve the size of the file. A solution with the same key as an
+    earlier one replaces it.
+    """
+    entries = {}
+    for key, plans, combos, frequencies, value in solutions:
+        entries[bytes(key)] = (tuple(plans), np.asarray(combos),
+                               np.asarray(frequencies), value)
+
+    # Keys are found through an open addressing hash table of at least twice as many
+    # slots as solutions, probed in order from the slot given by the key's first word.
+    capacity = 1 << max(len(entries) * 2 - 1, 1).bit_length()
+    slot_keys = np.zeros((capacity, 2), dtype='<u8')
+    slot_entries = np.full(capacity, -1, dtype=np.int32)
+    plan_sets = {}
+    hand_slots = np.full((len(entries), poker.NUM_COMBOS), -1, dtype=np.int16)
+    offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+    entry_plan_sets = np.zeros(len(entries), dtype=np.int32)
+    values = np.zeros(len(entries))
+    blocks = []
+    for entry, (key, (plans, combos, frequencies, value)) in enumerate(entries.items()):
+        words = _key_words(key)
+        slot = int(words[0]) & (capacity - 1)
+        while slot_entries[slot] >= 0:
+            slot = (slot + 1) & (capacity - 1)
+        slot_keys[slot] = words
+        slot_entries[slot] = entry
+        entry_plan_sets[entry] = plan_sets.setdefault(plans, len(plan_sets))
+        hand_slots[entry, combos] = np.arange(len(combos))
+        # Stored with a row for each hand, so that a hand's frequencies are together.
+        blocks.append(np.asarray(frequencies, dtype=dtype).T.ravel())
+        offsets[entry + 1] = offsets[entry] + blocks[-1].size
+        values[entry] = value
+
+    plan_text = [' '.join(plans).encode() for plans in plan_sets]
+    plan_offsets = np.cumsum([0] + [len(text) for text in plan_text], dtype=np.int64)
+    arrays = {'slot_keys': slot_keys,
+              'slot_entries': slot_entries,
+              'offsets': offsets,
+              'plan_sets': entry_plan_sets,
+              'hand_slots': hand_slots,
+              'values': values,
+              'plan_offsets': plan_offsets,
+              'plan_text': np.frombuffer(b''.join(plan_text), dtype=np.uint8),
+              'frequencies': (np.concatenate(blocks) if blocks
+                              else np.zeros(0, dtype=dtype))}
+    tables.save(path, arrays, STORE_VERSION, MAGIC)
+
+
+class StrategyStore:
+    """
+    A file written by save, opened with numpy.memmap. Solutions are found by their keys,
+    as given by solution_key, in constant time.
+    """
+    def __init__(self, path):
+        self.arrays = tables.load(path, STORE_VERSION, MAGIC, check=False)
+        self._capacity = len(self.arrays['slot_entries'])
+        self._plan_sets = {}
+
+    def __len__(self):
+        return len(self.arrays['values'])
+
+    def __contains__(self, key):
+        return self._entry(key) >= 0
+
+    def _entry(self, key):
+        """
+        Returns the number of the solution with key, or -1 if there is none.
+        """
+        words = _key_words(key)
+        slot_keys = self.arrays['slot_keys']
+        slot_entries = self.arrays['slot_entries']
+        slot = int(words[0]) & (self._capacity - 1)
+        while slot_entries[slot] >= 0:
+            if slot_keys[slot, 0] == words[0] and slot_keys[slot, 1] == words[1]:
+                return int(slot_entries[slot])
+            slot = (slot + 1) & (self._capacity - 1)
+        return -1
+
+    def _find(self, key):
+        entry = self._entry(key)
+        if entry < 0:
+            raise KeyError('No solution with key ' + key.hex())
+        return entry
+
+    def get_plans(self, key):
+        """
+        Returns the hero's plans in the solution with key.
+        """
+        plan_set = int(self.arrays['plan_sets'][self._find(key)])
+        if plan_set not in self._plan_sets:
+            start, stop = self.arrays['plan_offsets'][plan_set:plan_set + 2]
+            self._plan_sets[plan_set] = tuple(
+                self.arrays['plan_text'][start:stop].tobytes().decode().split())
+        return self._plan_sets[plan_set]
+
+    def value(self, key):
+        """
+        Returns the villain's best response EV against the solution with key.
+        """
+        return float(self.arrays['values'][self._find(key)])
+
+    def frequencies(self, key, hand):
+        """
+        Returns a dictionary of the frequency with which hand, a pair of cards, plays
+        each of the hero's plans in the solution with key. Raises KeyError if there is
+        no such solution or the hand is not in it.
+        """
+        entry = self._find(key)
+        # As Python ints, since the int16 slot times the number of plans can overflow.
+        slot = int(self.arrays['hand_slots'][entry, poker.combo_index(hand)])
+        if slot < 0:
+            raise KeyError('Hand is not in the hero range: ' + ''.join(map(str, hand)))
+        plans = self.get_plans(key)
+        start = int(self.arrays['offsets'][entry]) + slot * len(plans)
+        hand_frequencies = self.arrays['frequencies'][start:start + len(plans)]
+        return dict(zip(plans, hand_frequencies.astype(float).tolist()))
+
+
+def main(argv=None):
+    import batch
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('store', help='file to write the solutions to')
+    parser.add_argument('results', nargs='+', help='JSON lines files written by batch')
+    parser.add_argument('--hero-range', required=True)
+    parser.add_argument('--villain-range', required=True)
+    parser.add_argument('--float16', action='store_true',
+                        help='store frequencies as 16 bit rather than 32 bit floats')
+    args = parser.parse_args(argv)
+
+    hero_range = batch.parse_range(args.hero_range)
+    villain_range = batch.parse_range(args.villain_range)
+    solutions = []
+    for results_path in args.results:
+        with open(results_path) as results_file:
+            for line in results_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'error' in record:
+                    continue
+                solutions.append(batch_solution(record, hero_range, villain_range))
+    save(args.store, solutions, np.float16 if args.float16 else np.float32)
+    print('Wrote {} solutions to {}'.format(len(solutions), args.store))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,225 @@
+from collections import OrderedDict, namedtuple
+import hashlib
+import os
+import instrument
 import poker
+import numpy as np
 
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
 
-class StrategyTreeNode:
-    def __init__(self, pot_size=None, c=None, r=None, f=None):
-        self.pot_size = pot_size
-        self.c = c
-        self.r = r
-        self.f = f
-        self.range = poker.Range()
 
-    def __repr__(self):
-        return 'StrategyTreeNode(pot_size=' + str(self.pot_size) + ')'
+class LRUCache:
+    """
+    A cache holding at most maxsize entries, which drops the least recently used entry
+    to make room for a new one. hits and misses count the lookups which found and did
+    not find their key.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def fingerprint(weights):
+    """
+    Returns a short digest of the contents of an array of weights.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(weights), digest_size=16).digest()
+
+
+def best_response_ev(player, branches, ranges, wins, compatible, weights, gradient=False,
+                     hand_totals=None):
+    """
+    Does the work of StrategyTree.create_counter_strategy given the branches from
+    get_counter_plans, the ranges of the nodes listed with them restricted to the hero
+    hands, and the showdown matrices and weights for the responding hands. The result for
+    a set of responding hands is the sum of the results for any split of it, so the rows
+    of wins, compatible and weights can be handled in separate pieces. hand_totals may
+    give the pair (ranges @ wins.T, ranges @ compatible.T) if it is already known.
+    """
+    if hand_totals is None:
+        hand_totals = (ranges @ wins.T, ranges @ compatible.T)
+    total_ev, best_plans, branch_weights = _best_responses(player, branches, hand_totals,
+                                                           weights)
+    if not gradient:
+        return total_ev
+
+    hands = np.arange(len(weights))
+    win_weights = np.zeros((len(ranges), len(hands)))
+    size_weights = np.zeros((len(ranges), len(hands)))
+    for plans, best, chosen_weights in zip(branches, best_plans, branch_weights):
+        for plan_num, (plan, terms) in enumerate(plans):
+            plan_weights = chosen_weights * (best == plan_num)
+            for i, win_coef, size_coef in terms:
+                win_weights[i] += win_coef * plan_weights
+                size_weights[i] += size_coef * plan_weights
+    node_gradients = win_weights @ wins + size_weights @ compatible
+    return total_ev, node_gradients
+
+
+def best_response_strategy(player, branches, plans, ranges, wins, compatible, weights):
+    """
+    Takes the same arguments as best_response_ev, along with player's plans in the order
+    given by StrategyTree.get_plans, and returns a tuple (total EV, plan weights) where
+    plan weights has a row for each plan holding its weight on each responding hand in
+    the best response.
+    """
+    total_ev, best_plans, branch_weights = _best_responses(
+        player, branches, (ranges @ wins.T, ranges @ compatible.T), weights)
+    rows = {plan: row for row, plan in enumerate(plans)}
+    plan_weights = np.zeros((len(plans), len(weights)))
+    for branch, best, chosen_weights in zip(branches, best_plans, branch_weights):
+        for plan_num, (plan, terms) in enumerate(branch):
+            plan_weights[rows[plan]] += chosen_weights * (best == plan_num)
+    return total_ev, plan_weights
+
+
+def _best_responses(player, branches, hand_totals, weights):
+    """
+    Returns the total EV of player's best response, the number of the best plan in each
+    branch for each responding hand, and the weight each hand puts on each branch.
+    """
+    hand_wins, hand_sizes = hand_totals
+    hands = np.arange(len(weights))
+    best_plans = []
+    best_evs = []
+    for plans in branches:
+        plan_evs = np.array([sum(win_coef * hand_wins[i] + size_coef * hand_sizes[i]
+                                 for i, win_coef, size_coef in terms)
+                             for plan, terms in plans])
+        best_plans.append(plan_evs.argmax(axis=0))
+        best_evs.append(plan_evs[best_plans[-1], hands])
+    if player == 'ip':
+        total_ev = weights @ (best_evs[0] + best_evs[1])
+        branch_weights = (weights, weights)
+    else:
+        total_ev = weights @ np.maximum(best_evs[0], best_evs[1])
+        bet_first = best_evs[0] >= best_evs[1]
+        branch_weights = (weights * bet_first, weights * ~bet_first)
+    return total_ev, best_plans, branch_weights
+
+
+# The action for raising by each of a tree's bet sizes, in the order they are given.
+RAISE_ACTIONS = 'rstuvwxyz'
 
 
 class StrategyTree:
-    def __init__(self, board, starting_pot_size, stack_size, bet_size):
+    """
+    The betting tree for a single street, with one or more bet sizes. Every bet or raise
+    is one of bet_sizes times the pot after calling, and any which would put the caller
+    all in is an all in bet, of which only the first is kept.
+
+    Each node stands for the sequence of actions leading to it and is numbered, from
+    the root, 0, in the order nodes are created. Nodes are stored in flat arrays which
+    grow as nodes are added: pot_sizes holds each node's pot size, parents and depths
+    its parent and number of actions from the root, and children the node reached by
+    each action in actions or -1 where the action is not available. actions is 'f' and
+    'c' followed by a raise action from RAISE_ACTIONS for each bet size, so 'fcr' with a
+    single bet size. path gives the actions leading to a node and node finds the node
+    for a path.
+
+    A node's children are created when they are first asked for, through child or
+    expand, so walking part of a tree with several bet sizes only builds that part.
+    Plans, counter plans and node ranges need the whole tree and build it when first
+    used. Plans are only defined for a single bet size, where each is the path to the
+    node it ends at; get_plans and get_plan_ids return tables kept for each player.
+    ranges has a row for each node holding the weight on each combo of the hands whose
+    plans pass through it.
+
+    Showdown results for node ranges are kept in equity_cache, a LRUCache of at most
+    cache_size entries keyed on a fingerprint of the range, so nodes whose range is
+    unchanged between evaluations are not recomputed.
+
+    Repeated calls to set_strategy and create_counter_strategy only redo the work for
+    the hands whose weights changed since the previous call. Code which writes to ranges
+    directly rather than through the methods here should call clear_ranges first.
+    """
+    def __init__(self, board, starting_pot_size, stack_size, bet_size, cache_size=1024):
         self.board = board
-        self.plans = []
         self.starting_pot_size = starting_pot_size
-        self.root = self._generate_tree(starting_pot_size, stack_size, bet_size)
+        self.stack_size = stack_size
+        self.bet_sizes = tuple(bet_size) if np.iterable(bet_size) else (bet_size,)
+        if not 0 < len(self.bet_sizes) <= len(RAISE_ACTIONS):
+            raise ValueError('A tree needs between 1 and {} bet sizes'.format(
+                len(RAISE_ACTIONS)))
+        self.actions = 'fc' + RAISE_ACTIONS[:len(self.bet_sizes)]
+        # Each player's plans as paths and as the nodes they end at, in path order.
+        self._plans = {}
+        self._plan_ids = {}
+        self._counter_plans = {}
+        self._plan_incidence = {}
+        self.equity_cache = LRUCache(cache_size)
+        # The last strategy passed to set_strategy as (player, combos, plan weights), and
+        # the last showdown totals from create_counter_strategy as (player, showdown key,
+        # node ranges, hand wins, hand sizes).
+        self._last_strategy = None
+        self._last_totals = None
+        self._ranges = None
+        # Node arrays, of which the first _num_nodes rows are in use. bets holds the bet
+        # size the player to act at each node faces, or 0 if there is no bet.
+        self._num_nodes = 0
+        # Every node before this one has been expanded.
+        self._expanded_to = 0
+        self._pot_sizes = np.zeros(0)
+        self._bets = np.zeros(0)
+        self._parents = np.zeros(0, dtype=np.int32)
+        self._depths = np.zeros(0, dtype=np.int32)
+        self._last_actions = np.zeros(0, dtype=np.int8)
+        self._children = np.zeros((0, len(self.actions)), dtype=np.int32)
+        self._expanded = np.zeros(0, dtype=bool)
+        self.root = self.create_node(None, None, starting_pot_size)
+
+    @property
+    def num_nodes(self):
+        return self._num_nodes
+
+    @property
+    def pot_sizes(self):
+        return self._pot_sizes[:self._num_nodes]
+
+    @property
+    def parents(self):
+        return self._parents[:self._num_nodes]
+
+    @property
+    def depths(self):
+        return self._depths[:self._num_nodes]
+
+    @property
+    def children(self):
+        return self._children[:self._num_nodes]
+
+    @property
+    def ranges(self):
+        if self._ranges is None:
+            self.expand_all()
+            self._ranges = np.zeros((self._num_nodes, poker.NUM_COMBOS))
+        return self._ranges
 
     def amount_gained(self, pot_size):
         return (pot_size + self.starting_pot_size) / 2
@@ -27,131 +228,498 @@ class StrategyTree:
         return (pot_size - self.starting_pot_size) / 2
 
     def get_plans(self, player):
-        if player == 'ip':
-            return [p for p in self.plans if len(p) % 2 == 0]
-        else:
-            return [p for p in self.plans if len(p) % 2 == 1]
-
-    def create_node(self, plan, pot_size):
-        node = StrategyTreeNode(pot_size)
-        if plan[-1] == 'r':
-            try:
-                self.plans.remove(plan[:-1])
-            except ValueError:
-                pass
-        self.plans.append(plan)
+        """
+        Returns player's plans as a tuple of paths.
+        """
+        self._build_plans()
+        return self._plans[player]
+
+    def get_plan_ids(self, player):
+        """
+        Returns the nodes player's plans end at, in the order given by get_plans.
+        """
+        self._build_plans()
+        return self._plan_ids[player]
+
+    def _build_plans(self):
+        if self._plans:
+            return
+        self._build_plan_tree()
+        raises = self.children[:, self.actions.index('r')]
+        plans = sorted((self.path(node), node)
+                       for node in range(1, self._num_nodes) if raises[node] < 0)
+        for player in ('ip', 'oop'):
+            modval = self._modval(player)
+            player_plans = [(path, node) for path, node in plans
+                            if len(path) % 2 == modval]
+            self._plans[player] = tuple(path for path, node in player_plans)
+            self._plan_ids[player] = np.array([node for path, node in player_plans],
+                                              dtype=np.int32)
+
+    def _build_plan_tree(self):
+        """
+        Creates every node, which plans need, and raises ValueError if the tree has more
+        than one bet size, for which they are not defined.
+        """
+        if len(self.bet_sizes) > 1:
+            raise ValueError('Plans need a tree with a single bet size')
+        self.expand_all()
+
+    def child(self, node, action):
+        """
+        Returns the node reached by taking action at node, or -1 if there is none.
+        """
+        self.expand(node)
+        return self._children[node, self.actions.index(action)]
+
+    def action(self, node):
+        """
+        Returns the action leading to node, or None for the root.
+        """
+        if node == self.root:
+            return None
+        return self.actions[self._last_actions[node]]
+
+    def path(self, node):
+        """
+        Returns the actions leading to node as a string.
+        """
+        actions = []
+        while node > self.root:
+            actions.append(self.actions[self._last_actions[node]])
+            node = self._parents[node]
+        return ''.join(reversed(actions))
+
+    def node(self, path):
+        """
+        Returns the node reached by following path from the root, or -1 if there is
+        none.
+        """
+        node = self.root
+        for action in path:
+            if action not in self.actions:
+                return -1
+            node = self.child(node, action)
+            if node < 0:
+                return -1
         return node
 
-    def _generate_tree(self, starting_pot_size, stack_size, bet_size):
-        root = StrategyTreeNode(starting_pot_size)
-        root.r = self.create_node('r', starting_pot_size)
-        root.c = self.create_node('c', starting_pot_size)
-        root.c.r = self.create_node('cr', starting_pot_size)
-        root.c.c = self.create_node('cc', starting_pot_size)
-        expandable_nodes = [(root.r, 'r'), (root.c.r, 'cr')]
-        while expandable_nodes:
-            current, path = expandable_nodes.pop()
-            current_pot_size = current.pot_size
-            new_pot_size = current_pot_size * (1 + 2 * bet_size)
-            current.f = self.create_node(path + 'f', current_pot_size)
-            if (new_pot_size - starting_pot_size) / 2 >= stack_size:
-                current.c = self.create_node(path + 'c',
-                                             2 * stack_size + starting_pot_size)
-            else:
-                current.c = self.create_node(path + 'c', new_pot_size)
-                current.r = self.create_node(path + 'r', new_pot_size)
-                expandable_nodes.append((current.r, path + 'r'))
-        return root
+    def create_node(self, parent, action, pot_size, bet=0):
+        node = self._num_nodes
+        if node == len(self._pot_sizes):
+            self._grow()
+        self._num_nodes += 1
+        self._pot_sizes[node] = pot_size
+        self._bets[node] = bet
+        if parent is None:
+            self._parents[node] = -1
+            self._last_actions[node] = -1
+            return node
+        index = self.actions.index(action)
+        self._parents[node] = parent
+        self._depths[node] = self._depths[parent] + 1
+        self._last_actions[node] = index
+        self._children[parent, index] = node
+        return node
+
+    def _grow(self):
+        """
+        Doubles the room in the node arrays.
+        """
+        capacity = max(2 * len(self._pot_sizes), 64)
+        for name, fill in (('_pot_sizes', 0), ('_bets', 0), ('_parents', -1),
+                           ('_depths', 0), ('_last_actions', -1), ('_children', -1),
+                           ('_expanded', False)):
+            array = getattr(self, name)
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def expand(self, node):
+        """
+        Creates node's children if they have not been created yet.
+        """
+        if self._expanded[node]:
+            return
+        self._expanded[node] = True
+        action = self.action(node)
+        pot_size = self._pot_sizes[node]
+        if action == 'f' or action == 'c' and self._depths[node] > 1:
+            return
+        if action is None or action == 'c':
+            self._create_raises(node, pot_size)
+            self.create_node(node, 'c', pot_size)
+            return
+        new_pot_size = pot_size * (1 + 2 * self._bets[node])
+        self.create_node(node, 'f', pot_size)
+        if self.amount_lost(new_pot_size) >= self.stack_size:
+            self.create_node(node, 'c', 2 * self.stack_size + self.starting_pot_size)
+        else:
+            self.create_node(node, 'c', new_pot_size)
+            self._create_raises(node, new_pot_size)
+
+    def _create_raises(self, node, pot_size):
+        all_in = False
+        for action, bet_size in zip(RAISE_ACTIONS, self.bet_sizes):
+            if self.amount_lost(pot_size * (1 + 2 * bet_size)) >= self.stack_size:
+                if all_in:
+                    continue
+                all_in = True
+            self.create_node(node, action, pot_size, bet_size)
+
+    def expand_all(self):
+        """
+        Creates every node of the tree.
+        """
+        while self._expanded_to < self._num_nodes:
+            self.expand(self._expanded_to)
+            self._expanded_to += 1
 
     def clear_ranges(self):
-        frontier = [self.root]
-        while frontier:
-            current = frontier.pop()
-            current.range = poker.Range()
-            if current.f is not None:
-                frontier.append(current.f)
-            if current.c is not None:
-                frontier.append(current.c)
-            if current.r is not None:
-                frontier.append(current.r)
+        if self._ranges is not None:
+            self._ranges.fill(0)
+        self._last_strategy = None
 
-    def modify_nodes_by_plan(self, plan, plan_range):
-        current_node = self.root
+    def get_range(self, node):
+        """
+        Returns a copy of node's range as a poker.Range.
+        """
+        return poker.Range(self.ranges[node])
+
+    def get_plan_nodes(self, plan):
+        """
+        Returns the nodes reached by following plan from the root, in order.
+        """
+        nodes = []
+        node = self.root
         for action in plan:
-            current_node = getattr(current_node, action)
-            current_node.range += plan_range
+            node = self.child(node, action)
+            nodes.append(node)
+        return nodes
 
-    def create_counter_strategy(self, player, hand_range):
-        # TODO: Assert opponent plans are filled in
-        total_ev = 0
-        if player == 'ip':
-            for hand, weight in hand_range.items():
-                ev_r, plan_r = self.get_highest_ev_plan(player, hand, self.root.r, 'r')
-                ev_c, plan_c = self.get_highest_ev_plan(player, hand, self.root.c, 'c')
-                total_ev += weight * (ev_r + ev_c)
-        elif player == 'oop':
-            for hand, weight in hand_range.items():
-                ev_r, plan_r = self.get_highest_ev_plan(player, hand, self.root.r, 'r')
-                ev_c, plan_c = self.get_highest_ev_plan(player, hand, self.root.c, 'c')
-                total_ev += weight * max(ev_r, ev_c)
+    def get_plan_incidence(self, player):
+        """
+        Returns a matrix with a row for each of player's plans, in the order given by
+        get_plans, and a column for each node, which is 1 where the plan passes through
+        the node and 0 elsewhere.
+        """
+        if player not in self._plan_incidence:
+            plans = self.get_plans(player)
+            incidence = np.zeros((len(plans), self._num_nodes))
+            for i, plan in enumerate(plans):
+                incidence[i, self.get_plan_nodes(plan)] = 1
+            self._plan_incidence[player] = incidence
+        return self._plan_incidence[player]
+
+    def set_strategy(self, player, plan_weights, combos=slice(None)):
+        """
+        Replaces the node ranges with those given by a strategy for player. plan_weights
+        has a row for each of player's plans, in the order given by get_plans, holding
+        the plan's weight on each of the given combos.
+
+        If the previous call was for the same player and combos, only the combos whose
+        plan weights changed are recomputed.
+        """
+        with instrument.timer('set_strategy'):
+            combos = np.arange(poker.NUM_COMBOS)[combos]
+            plan_weights = np.array(plan_weights, dtype=float)
+            incidence = self.get_plan_incidence(player).T
+            last = self._last_strategy
+            if (last is not None and last[0] == player
+                    and np.array_equal(last[1], combos)
+                    and last[2].shape == plan_weights.shape):
+                changed = np.flatnonzero((last[2] != plan_weights).any(axis=0))
+                self.ranges[:, combos[changed]] = incidence @ plan_weights[:, changed]
+                instrument.count('changed_strategy_hands', len(changed))
+            else:
+                self.ranges.fill(0)
+                self.ranges[:, combos] = incidence @ plan_weights
+                instrument.count('full_strategy_updates')
+            self._last_strategy = (player, combos, plan_weights)
+
+    def modify_nodes_by_plan(self, plan, plan_range):
+        self.ranges[self.get_plan_nodes(plan)] += plan_range.weights
+        self._last_strategy = None
+
+    def create_counter_strategy(self, player, hand_range, showdown=None, gradient=False):
+        """
+        Returns the total EV of the best response by player to the other player's
+        strategy, which must already be filled in to the node ranges, weighted by the
+        hands in hand_range. showdown is a poker.Showdown with player's hands as the
+        villain hands; one is built if it is not given, but callers evaluating many
+        strategies should build it once and pass it in.
+
+        If gradient is True, returns a tuple (total EV, node gradients) instead, where
+        node gradients has a row for each node listed by get_counter_plans holding the
+        derivative of the total EV with respect to that node's weight on each of the
+        showdown's hero hands, with the best response held fixed.
+        """
+        if not isinstance(hand_range, poker.Range):
+            hand_range = poker.Range(hand_range)
+        if showdown is None:
+            showdown = poker.Showdown(
+                self.board, poker.Range(self.ranges[self.child(self.root, 'r')]
+                                        + self.ranges[self.child(self.root, 'c')]),
+                hand_range)
+        with instrument.timer('counter_strategy'):
+            return self._counter_strategy(player, hand_range, showdown, gradient)
+
+    def _counter_strategy(self, player, hand_range, showdown, gradient):
+        nodes, branches = self.get_counter_plans(player)
+        ranges = self.ranges[np.ix_(nodes, showdown.hero_combos)]
+        last = self._last_totals
+        if last is not None and last[:2] == (player, showdown.key):
+            last_ranges, hand_wins, hand_sizes = last[2:]
+            changed = np.flatnonzero((last_ranges != ranges).any(axis=0))
         else:
-            raise ValueError("Player must be 'ip' or 'oop'")
-        return total_ev
+            changed = None
+        # Updating by the change costs about as much as starting again once half of the
+        # hands have changed, and starting again clears any accumulated rounding error.
+        if changed is None or 2 * len(changed) > ranges.shape[1]:
+            hand_wins, hand_sizes = self._hand_totals(ranges, showdown)
+            instrument.count('full_showdown_totals')
+        elif len(changed):
+            instrument.count('changed_showdown_hands', len(changed))
+            delta = ranges[:, changed] - last_ranges[:, changed]
+            hand_wins = hand_wins + delta @ showdown.wins[:, changed].T
+            hand_sizes = hand_sizes + delta @ showdown.compatible[:, changed].T
+        self._last_totals = (player, showdown.key, ranges, hand_wins, hand_sizes)
+        return best_response_ev(player, branches, ranges, showdown.wins,
+                                showdown.compatible,
+                                hand_range.weights[showdown.villain_combos], gradient,
+                                (hand_wins, hand_sizes))
+
+    def _hand_totals(self, ranges, showdown):
+        """
+        Returns the weight of each node range which each of the showdown's villain hands
+        beats and is compatible with, as two arrays with a row for each range, taking
+        rows from equity_cache where it has them.
+        """
+        shape = (len(ranges), len(showdown.villain_combos))
+        hand_wins = np.empty(shape)
+        hand_sizes = np.empty(shape)
+        keys = [(showdown.key, fingerprint(row)) for row in ranges]
+        missing = []
+        for i, key in enumerate(keys):
+            cached = self.equity_cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                hand_wins[i], hand_sizes[i] = cached
+        if missing:
+            hand_wins[missing] = ranges[missing] @ showdown.wins.T
+            hand_sizes[missing] = ranges[missing] @ showdown.compatible.T
+            for i in missing:
+                self.equity_cache.put(keys[i],
+                                      (hand_wins[i].copy(), hand_sizes[i].copy()))
+        return hand_wins, hand_sizes
+
+    def best_response(self, player, opponent_weights, hand_range, showdown):
+        """
+        Returns a tuple (total EV, plan weights) for the best response by player, with
+        the hands in hand_range, to a strategy for the other player given as the weight
+        each of their plans puts on each of showdown's hero hands. showdown has player's
+        hands as its villain hands, and plan weights has a row for each of player's plans
+        holding its weight on each of them. The node ranges are not used or changed.
+        """
+        nodes, branches = self.get_counter_plans(player)
+        opponent = 'ip' if player == 'oop' else 'oop'
+        ranges = self.get_plan_incidence(opponent)[:, nodes].T @ opponent_weights
+        return best_response_strategy(player, branches, self.get_plans(player), ranges,
+                                      showdown.wins, showdown.compatible,
+                                      hand_range.weights[showdown.villain_combos])
+
+    def exploitability(self, strategies, hand_ranges, showdown):
+        """
+        Returns how much the two players could gain in total by switching to best
+        responses against each other's strategies, and a dictionary of the EV of each
+        player's best response. strategies and hand_ranges map each player to the weight
+        each of their plans puts on each of their hands and to their range. The first
+        player listed in strategies holds showdown's villain hands and the other its hero
+        hands. Both players' EVs add up to the starting pot for every pair of hands, so
+        the total is 0 exactly when the strategies are an equilibrium.
+        """
+        villain, hero = strategies
+        showdowns = {villain: showdown, hero: showdown.transposed()}
+        values = {}
+        for player, opponent in ((villain, hero), (hero, villain)):
+            values[player] = self.best_response(player, strategies[opponent],
+                                                hand_ranges[player],
+                                                showdowns[player])[0]
+        compatible_weight = (hand_ranges[villain].weights[showdown.villain_combos]
+                             @ showdown.compatible
+                             @ hand_ranges[hero].weights[showdown.hero_combos])
+        return (values[villain] + values[hero]
+                - self.starting_pot_size * compatible_weight, values)
+
+    def get_dominated_plans(self, player, showdown, weights):
+        """
+        Returns a boolean array with a row for each of player's plans, in the order given
+        by get_plans, and a column for each of showdown's hero hands, which are player's,
+        that is True where the hand can drop the plan because one of its other plans,
+        which is kept, does at least as well against every hand and strategy of the
+        other player. weights holds the other player's weight on each of showdown's
+        villain hands, and only the villain hands with weight are considered.
+
+        Two plans share the other player's actions up to the node where player's actions
+        differ, so one dominates the other if its best result for the other player after
+        that node is no better than the other's worst. Each result is linear in the
+        villain hand's equity, so for each hero hand this only needs checking at the
+        lowest and highest equities of the villain hands it can meet.
+        """
+        plans = self.get_plans(player)
+        modval = self._modval(player)
+        relevant = (showdown.compatible > 0) & (weights[:, np.newaxis] > 0)
+        met = relevant.any(axis=0)
+        low = np.where(relevant, showdown.wins, np.inf).min(axis=0)
+        high = np.where(relevant, showdown.wins, -np.inf).max(axis=0)
+        equities = np.where(met, [low, high], 0)
+        # The other player's results after each plan as (position, win_coef, size_coef),
+        # where position is the number of the plan's actions taken before the result.
+        results = []
+        for plan in plans:
+            nodes = [self.root] + self.get_plan_nodes(plan)
+            plan_results = []
+            for position, node in enumerate(nodes):
+                if position == len(plan):
+                    outcomes = [node]
+                elif self.depths[node] % 2 == modval:
+                    outcomes = [child for child in self.children[node]
+                                if child >= 0 and child != nodes[position + 1]]
+                else:
+                    continue
+                while outcomes:
+                    outcome = outcomes.pop()
+                    if (self.children[outcome] >= 0).any():
+                        outcomes.extend(child for child in self.children[outcome]
+                                        if child >= 0)
+                    else:
+                        plan_results.append((position,)
+                                            + self._result_coefs(player, outcome))
+            results.append(plan_results)
+
+        def bound(plan_results, start, best):
+            values = [win_coef * equities + size_coef
+                      for position, win_coef, size_coef in plan_results
+                      if position > start]
+            return np.max(values, axis=0) if best else np.min(values, axis=0)
+
+        dominated = np.zeros((len(plans), len(met)), dtype=bool)
+        for i, plan in enumerate(plans):
+            for j, other in enumerate(plans):
+                start = len(os.path.commonprefix((plan, other)))
+                if i == j or self.depths[self.node(plan[:start])] % 2 == modval:
+                    continue
+                dominates = ((bound(results[j], start, True)
+                              <= bound(results[i], start, False) + 1e-9).all(axis=0)
+                             | ~met) & ~dominated[j]
+                dominated[i] |= dominates
+        return dominated
+
+    def _result_coefs(self, player, node):
+        """
+        Returns (win_coef, size_coef) for the other player's result at the terminal
+        node, as in the terms of _counter_plans_from.
+        """
+        pot_size = self.pot_sizes[node]
+        if self.action(node) != 'f':
+            return pot_size, -self.amount_lost(pot_size)
+        if self.depths[self.parents[node]] % 2 == self._modval(player):
+            return 0, -self.amount_lost(pot_size)
+        return 0, self.amount_gained(pot_size)
+
+    def get_counter_plans(self, player):
+        """
+        Returns the plans player can use in response to the other player's strategy as a
+        tuple (nodes, branches). branches holds a list of plans for each of player's
+        possible situations after the first action, and each plan is a pair (plan, terms)
+        whose terms refer to nodes by their position in nodes.
+        """
+        if player not in self._counter_plans:
+            self._build_plan_tree()
+            nodes = []
+            positions = {}
+            branches = []
+            for action in 'rc':
+                plans = []
+                for plan, terms in self._counter_plans_from(
+                        player, self.child(self.root, action), action):
+                    for term_node, win_coef, size_coef in terms:
+                        if term_node not in positions:
+                            positions[term_node] = len(nodes)
+                            nodes.append(term_node)
+                    plans.append((plan, [(positions[term_node], win_coef, size_coef)
+                                         for term_node, win_coef, size_coef in terms]))
+                branches.append(plans)
+            self._counter_plans[player] = (nodes, branches)
+        return self._counter_plans[player]
+
+    def _counter_plans_from(self, player, node, start_path):
+        """
+        Lists the plans player can follow from node, which the other player has just
+        reached by acting, as (plan, terms) pairs. The EV of a plan for a given hand is
+        the sum over its terms (node, win_coef, size_coef) of win_coef times the weight
+        of node's range which the hand beats at showdown, counting ties as half, plus
+        size_coef times the weight of node's range which does not share a card with it.
+        """
+        self._build_plan_tree()
+        modval = self._modval(player)
+        plans = []
+        terms = []
+        current, path = node, start_path
+        while True:
+            fold, call, raise_ = self.children[current]
+            if len(path) % 2 == modval:
+                if fold >= 0:
+                    terms.append((fold, 0, self.amount_gained(self.pot_sizes[current])))
+                terms.append((call, self.pot_sizes[call],
+                              -self.amount_lost(self.pot_sizes[call])))
+            else:
+                plans.append((path + 'c',
+                              terms + [(current, self.pot_sizes[call],
+                                        -self.amount_lost(self.pot_sizes[call]))]))
+                if fold >= 0:
+                    plans.append((path + 'f',
+                                  terms + [(current, 0,
+                                            -self.amount_lost(self.pot_sizes[current]))]))
+            if raise_ < 0:
+                if len(path) % 2 == modval:
+                    plans.append((path, terms))
+                return plans
+            current, path = raise_, path + 'r'
 
     def get_highest_ev_plan(self, player, hand, node, start_path):
-        if player == 'ip':
-            modval = 0
-        elif player == 'oop':
-            modval = 1
-        else:
-            raise ValueError("Player must be 'ip' or 'oop'")
-        ev = 0
-        max_ev = -1
+        instrument.count('highest_ev_plan')
+        blockers = poker.hand_mask(hand) | poker.hand_mask(self.board)
+        max_ev = None
         max_plan = None
-        frontier = [(node, start_path)]
-        while frontier:
-            current, path = frontier.pop()
-            if (len(path) % 2 == modval):
-                if current.f is not None:
-                    ev += (current.f.range.size(remove=hand)
-                           * self.amount_gained(current.pot_size))
-                equity = poker.equity_hand_vs_range(hand, current.c.range, self.board)
-                ev += (current.c.range.size(remove=hand)
-                       * (equity * current.c.pot_size
-                          - self.amount_lost(current.c.pot_size)))
-            else:
-                equity = poker.equity_hand_vs_range(hand, current.range, self.board)
-                plan_ev = (ev
-                           + current.range.size(remove=hand)
-                           * (equity
-                              * current.c.pot_size
-                              - self.amount_lost(current.c.pot_size)))
-                if plan_ev > max_ev:
-                    max_ev = plan_ev
-                    max_plan = path + 'c'
-                plan_ev = (ev
-                           - current.range.size(remove=hand)
-                           * self.amount_lost(current.pot_size))
-                if plan_ev > max_ev:
-                    max_ev = plan_ev
-                    max_plan = path + 'f'
-            if current.r is not None:
-                frontier.append((current.r, path + 'r'))
-            elif ev > max_ev:
+        for plan, terms in self._counter_plans_from(player, node, start_path):
+            ev = 0
+            for term_node, win_coef, size_coef in terms:
+                term_range = self.get_range(term_node)
+                size = term_range.size(remove=blockers)
+                if win_coef:
+                    key = (poker.combo_index(hand), fingerprint(term_range.weights),
+                           poker.hand_mask(self.board))
+                    equity = self.equity_cache.get(key)
+                    if equity is None:
+                        equity = poker.equity_hand_vs_range(hand, term_range, self.board)
+                        self.equity_cache.put(key, equity)
+                    ev += win_coef * equity * size
+                ev += size_coef * size
+            if max_ev is None or ev > max_ev:
                 max_ev = ev
-                max_plan = path
+                max_plan = plan
         return (max_ev, max_plan)
 
+    @staticmethod
+    def _modval(player):
+        if player == 'ip':
+            return 0
+        elif player == 'oop':
+            return 1
+        raise ValueError("Player must be 'ip' or 'oop'")
+
     def __repr__(self):
-        result = ''
-        frontier = [(self.root, '')]
-        while frontier:
-            current, path = frontier.pop()
-            result += path + ': ' + str(current.range) + '\n'
-            if current.f is not None:
-                frontier.append((current.f, path + 'f'))
-            if current.c is not None:
-                frontier.append((current.c, path + 'c'))
-            if current.r is not None:
-                frontier.append((current.r, path + 'r'))
-        return result
+        return ''.join(self.path(node) + ': ' + str(self.get_range(node)) + '\n'
+                       for node in range(self.num_nodes))
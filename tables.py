@@ -0,0 +1,114 @@
+"""
+Reads and writes the binary file holding poker's evaluation tables, so that they are
+built once rather than in every process. The file is opened with numpy.memmap, so the
+processes using it share its pages. The same format holds other sets of arrays, such as
+the solutions in store, under a different magic string.
+
+The file starts with a fixed header giving the format version, the version of the
+tables' contents, the length of a JSON directory listing each array's dtype, shape and
+offset, and a SHA-256 checksum of everything after the header. Arrays are aligned to 64
+bytes.
+
+Run this module to rebuild the file:
+
+    python tables.py [path]
+"""
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+
+MAGIC = b'PKRTABLE'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQ32s')
+ALIGNMENT = 64
+
+
+class TableError(Exception):
+    """
+    Raised when a table file is not in the expected format, has a different version or
+    fails its checksum.
+    """
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save(path, arrays, version, magic=MAGIC):
+    """
+    Writes a dictionary of arrays to path, replacing any existing file only once the new
+    one is complete.
+    """
+    directory = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _aligned(offset)
+        directory[name] = {'dtype': array.dtype.str, 'shape': array.shape,
+                           'offset': offset}
+        offset += array.nbytes
+    directory_bytes = json.dumps(directory).encode()
+    body_start = _aligned(HEADER.size + len(directory_bytes))
+    body = bytearray(_aligned(offset))
+    for name, array in arrays.items():
+        start = directory[name]['offset']
+        body[start:start + array.nbytes] = np.ascontiguousarray(array).tobytes()
+    padding = bytes(body_start - HEADER.size - len(directory_bytes))
+    checksum = hashlib.sha256(directory_bytes + padding + body).digest()
+    header = HEADER.pack(magic, FORMAT_VERSION, version, len(directory_bytes), checksum)
+
+    path = os.path.abspath(path)
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(descriptor, 'wb') as table_file:
+            table_file.write(header + directory_bytes + padding + body)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def load(path, version, magic=MAGIC, check=True):
+    """
+    Returns a dictionary of read only arrays mapped from the file at path. Raises
+    OSError if it cannot be read and TableError if it is not a valid table file of the
+    given version. check=False skips the checksum, which reads the whole file, so that
+    only the pages which are used are read.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if len(data) < HEADER.size:
+        raise TableError('Table file is truncated')
+    file_magic, format_version, file_version, directory_size, checksum = HEADER.unpack(
+        data[:HEADER.size].tobytes())
+    if file_magic != magic:
+        raise TableError('Not a table file')
+    if (format_version, file_version) != (FORMAT_VERSION, version):
+        raise TableError('Table file has version {}.{}, expected {}.{}'.format(
+            format_version, file_version, FORMAT_VERSION, version))
+    if check and hashlib.sha256(data[HEADER.size:]).digest() != checksum:
+        raise TableError('Table file checksum does not match')
+    directory = json.loads(data[HEADER.size:HEADER.size + directory_size].tobytes())
+    body_start = _aligned(HEADER.size + directory_size)
+    arrays = {}
+    for name, entry in directory.items():
+        dtype = np.dtype(entry['dtype'])
+        start = body_start + entry['offset']
+        size = dtype.itemsize * int(np.prod(entry['shape']))
+        arrays[name] = data[start:start + size].view(dtype).reshape(entry['shape'])
+    return arrays
+
+
+def main(argv=None):
+    import poker
+    argv = sys.argv[1:] if argv is None else argv
+    path = argv[0] if argv else poker.TABLES_PATH
+    save(path, poker.build_table_arrays(), poker.TABLES_VERSION)
+    print('Wrote {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
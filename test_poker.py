@@ -1,6 +1,19 @@
 import poker
+import asyncio
+import inspect
+import json
+import os
+import tempfile
+import threading
 import unittest
+import numpy as np
+from scipy.optimize import approx_fprime
+import batch
+import instrument
 import solver
+import store
+import strategy
+import tables
 
 
 class TestPoker(unittest.TestCase):
@@ -59,6 +72,81 @@ class TestPoker(unittest.TestCase):
         with self.assertRaises(ValueError):
             poker.evaluate_hand(self.eight_cards)
 
+    def test_hand_strength(self):
+        hands = [self.high_card, self.one_pair, self.two_pair, self.trips, self.wheel,
+                 self.straight, self.flush, self.full_house, self.extra_full_house,
+                 self.quads, self.steel_wheel, self.straight_flush]
+        strengths = [poker.hand_strength(hand) for hand in hands]
+        self.assertEqual(strengths, sorted(strengths))
+        self.assertEqual(len(set(strengths)), len(strengths))
+        self.assertEqual(poker.hand_strength(poker.make_hand('As Kd 8c 5h 2s 3c 4d')),
+                         poker.hand_strength(poker.make_hand('Ah Kc 8s 5d 2c 3d 4s')))
+        self.assertEqual(poker.evaluate_hand(poker.make_hand('Jh Jd 8c 8s 2d 2c 3c')),
+                         (2, (9, 6, 1)))
+        with self.assertRaises(ValueError):
+            poker.hand_strength(self.four_cards)
+
+    def test_evaluate_hands_batch(self):
+        hands = [self.straight_flush, self.steel_wheel, self.quads, self.full_house,
+                 self.flush, self.straight, self.wheel, self.two_pair, self.high_card]
+        strengths = poker.evaluate_hands_batch([[card.index for card in hand]
+                                                for hand in hands])
+        self.assertEqual(list(strengths), [poker.hand_strength(hand) for hand in hands])
+        strengths = poker.evaluate_hands_batch([[card.index for card in
+                                                 self.five_cards_trips]])
+        self.assertEqual(list(strengths), [poker.hand_strength(self.five_cards_trips)])
+        with self.assertRaises(ValueError):
+            poker.evaluate_hands_batch([[card.index for card in self.four_cards]])
+
+    def test_tables(self):
+        arrays = {'a': np.arange(5, dtype=np.int64), 'b': np.ones((2, 3), dtype=np.int8)}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tables.bin')
+            tables.save(path, arrays, 3)
+            loaded = tables.load(path, 3)
+            for name, array in arrays.items():
+                np.testing.assert_array_equal(loaded[name], array)
+            with self.assertRaises(tables.TableError):
+                tables.load(path, 4)
+            with open(path, 'r+b') as table_file:
+                table_file.seek(-1, os.SEEK_END)
+                table_file.write(b'\x01')
+            with self.assertRaises(tables.TableError):
+                tables.load(path, 3)
+        built = poker.build_table_arrays()
+        np.testing.assert_array_equal(built['rank_displacements'],
+                                      poker.RANK_DISPLACEMENT_ARRAY)
+        np.testing.assert_array_equal(built['rank_values'], poker.RANK_VALUE_ARRAY)
+        np.testing.assert_array_equal(built['flush'], poker.FLUSH_ARRAY)
+
+    def test_card(self):
+        self.assertIs(poker.Card.from_str('Qh'), poker.Card(10, 1))
+        self.assertIs(poker.make_hand('Qh')[0], poker.DECK[poker.Card(10, 1).index])
+        self.assertEqual(poker.hand_mask(self.pocket_aces),
+                         poker.Card.from_str('As').mask | poker.Card.from_str('Ac').mask)
+        self.assertEqual(self.range1.size(remove=self.pocket_aces[:1]), 5)
+        self.assertEqual(self.range1.size(remove=poker.hand_mask(self.board1)), 6)
+        with self.assertRaises(AttributeError):
+            self.pocket_aces[0].extra = None
+
+    def test_range(self):
+        self.assertEqual(len(self.range1.hand_weights), 3)
+        self.assertEqual(self.range1.hand_weights[tuple(self.pocket_aces[::-1])], 1)
+        self.assertEqual(self.range1.hand_weights[tuple(self.pocket_kings)], 0)
+        self.assertNotIn(tuple(self.pocket_kings), self.range1.hand_weights)
+        for hand in (self.pocket_aces, self.pocket_fives, poker.make_hand('6s 2d')):
+            self.assertEqual(self.range1.size(remove=hand),
+                             sum(w for h, w in self.range1.hand_weights.items()
+                                 if not poker.hand_mask(h) & poker.hand_mask(hand)))
+        combined = self.range1 + self.range2
+        self.assertEqual(combined.size(), 8)
+        self.assertEqual(combined.size(remove=self.pocket_kings[:1]), 7)
+        combined.hand_weights[tuple(self.pocket_queens)] = 2
+        self.assertEqual(combined.size(), 10)
+        combined.normalize()
+        self.assertAlmostEqual(combined.size(), 1)
+        self.assertAlmostEqual(combined.card_weights[self.pocket_queens[0].index], .2)
+
     def test_equity_hand_vs_range(self):
         equity = poker.equity_hand_vs_range(self.pocket_kings,
                                             self.range1,
@@ -69,12 +157,217 @@ class TestPoker(unittest.TestCase):
                                             self.board1)
         self.assertEqual(equity, 3/4)
 
+    def test_equities_vs_range(self):
+        equities = poker.equities_vs_range(self.range1, self.board1)
+        for hand in (self.pocket_kings, self.pocket_fives, self.pocket_queens,
+                     poker.make_hand('Ah 6h')):
+            self.assertAlmostEqual(equities[poker.combo_index(hand)],
+                                   poker.equity_hand_vs_range(hand, self.range1,
+                                                              self.board1))
+        # Showdowns are only defined on complete boards, so that they cannot disagree
+        # with the runout equities.
+        for board in (self.board1[:3], self.board1[:4]):
+            with self.assertRaises(ValueError):
+                poker.equities_vs_range(self.range1, board)
+            with self.assertRaises(ValueError):
+                poker.Showdown(board, self.range1, self.range1)
+        self.assertEqual(equities[poker.combo_index(poker.make_hand('Ks Kd'))], 1)
+
+    def test_suit_isomorphism(self):
+        board = poker.make_hand('2s 3s 4c 6c 7h')
+        self.assertEqual(poker.canonical_board(board)[0],
+                         poker.canonical_board(self.board2)[0])
+        ranked = poker.ranked_board(board)
+        direct = poker.RankedBoard(board)
+        np.testing.assert_array_equal(ranked.strengths, direct.strengths)
+
+        board = poker.make_hand('As Ks 8s 5s 2s')
+        hand_range = poker.Range({hand: 1 for hand in poker.COMBOS
+                                  if hand[0].rank == hand[1].rank >= 9
+                                  and hand[0] not in board and hand[1] not in board})
+        reduced = solver.Solver(board, hand_range, hand_range, 'ip', .5, .5)
+        full = solver.Solver(board, hand_range, hand_range, 'ip', .5, .5,
+                             reduce_suits=False)
+        self.assertEqual(len(reduced.solve_showdown.hero_combos) * 3,
+                         len(full.solve_showdown.hero_combos))
+        result = reduced.create_optimal_strategy()
+        self.assertAlmostEqual(result.fun, full.create_optimal_strategy().fun, places=5)
+        self.assertEqual(len(result.jac), len(result.x))
+        np.testing.assert_allclose(result.jac,
+                                   reduced.evaluate_strategy(result.x, gradient=True)[1])
+
     def test_equity_range_vs_range(self):
         equity = poker.equity_range_vs_range(self.range1,
                                              self.range2,
                                              self.board1)
         self.assertEqual(equity, 0.3)
 
+    def test_runout_equity(self):
+        hand = self.pocket_queens
+        board = self.board1[:4]
+        wins = total = 0
+        for card in poker.DECK:
+            if card in board or card in hand:
+                continue
+            runout = board + [card]
+            for villain_hand, weight in self.range1.hand_weights.items():
+                if any(c in runout or c in hand for c in villain_hand):
+                    continue
+                hero_strength = poker.hand_strength(list(hand) + runout)
+                villain_strength = poker.hand_strength(list(villain_hand) + runout)
+                wins += weight * ((hero_strength > villain_strength)
+                                  + (hero_strength == villain_strength) / 2)
+                total += weight
+        exact = poker.runout_equity(hand, self.range1, board)
+        self.assertAlmostEqual(exact.equity, wins / total)
+        self.assertEqual(exact.error, 0)
+        self.assertAlmostEqual(poker.equity_hand_vs_range(hand, self.range1, board),
+                               wins / total)
+
+        estimate = poker.runout_equity(hand, self.range1, board[:3], tolerance=.02,
+                                       seed=0)
+        self.assertLessEqual(estimate.error, .02)
+        exact = poker.runout_equity(hand, self.range1, board[:3])
+        self.assertAlmostEqual(estimate.equity, exact.equity, delta=4 * estimate.error)
+        # Sampling without replacement ends with every runout, which gives the exact
+        # equity rather than going on forever.
+        estimate = poker.runout_equity(hand, self.range1, board[:3], tolerance=0, seed=0)
+        self.assertEqual(estimate.error, 0)
+        self.assertEqual(estimate.samples, exact.samples)
+        self.assertAlmostEqual(estimate.equity, exact.equity)
+
+    def test_strategy_tree(self):
+        tree = strategy.StrategyTree(self.board2, 1, 2, .5)
+        plans = tree.get_plans('ip')
+        plan_weights = np.random.default_rng(0).random((len(plans), poker.NUM_COMBOS))
+        for plan, weights in zip(plans, plan_weights):
+            tree.modify_nodes_by_plan(plan, poker.Range(weights))
+        expected = tree.ranges.copy()
+        tree.clear_ranges()
+        self.assertFalse(tree.ranges.any())
+        tree.set_strategy('ip', plan_weights)
+        np.testing.assert_allclose(tree.ranges, expected)
+        self.assertEqual(tree.pot_sizes[tree.node('rc')], 2)
+        self.assertEqual(tree.child(tree.node('rc'), 'r'), -1)
+
+    def test_bet_sizes(self):
+        tree = strategy.StrategyTree(self.board2, 1, 2, (.5, 2, 3))
+        self.assertEqual(tree.num_nodes, 1)
+        # Betting 2 or 3 times the pot puts the caller all in, so only the first is kept.
+        self.assertEqual([tree.child(tree.root, action) >= 0 for action in tree.actions],
+                         [False, True, True, True, False])
+        self.assertEqual(tree.num_nodes, 4)
+        node = tree.node('crs')
+        self.assertEqual(tree.path(node), 'crs')
+        call = tree.child(node, 'c')
+        self.assertEqual(tree.pot_sizes[call], 5)
+        self.assertEqual(tree.node('crt'), -1)
+        self.assertEqual(tree.node('cu'), -1)
+        with self.assertRaises(ValueError):
+            tree.get_plans('ip')
+
+        s = solver.CFRSolver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', (.5, 1), 1)
+        self.assertEqual(s.strategy_tree.num_nodes, 1)
+        strat = s.create_optimal_strategy(iterations=100)
+        self.assertIsNone(strat.x)
+        self.assertLess(strat.exploitability[-1], strat.exploitability[0] / 10)
+        # ip acts after a check, a bet of either size and a check-raise.
+        self.assertEqual(sorted(strat.strategy), ['c', 'crr', 'r', 's'])
+        self.assertEqual(list(strat.strategy['r']), ['f', 'c', 'r'])
+        for frequencies in strat.strategy.values():
+            np.testing.assert_allclose(sum(frequencies.values()),
+                                       np.ones(len(s.hero_combos)))
+        # Swapping clubs and spades fixes this board and range, so hands are reduced.
+        board = poker.make_hand('2h 3h 4h 6d 7d')
+        hand_range = poker.Range({tuple(poker.make_hand(hand)): 1
+                                  for hand in ('Qc Qh', 'Qs Qh', 'Kc Kd', 'Ks Kd',
+                                               'Ac As', '2c 5s', '5c 2s')})
+        strategies = []
+        for reduce_suits in (True, False):
+            s = solver.CFRSolver(board, hand_range, hand_range, 'ip', (.5, 1), 1,
+                                 reduce_suits=reduce_suits)
+            strategies.append(s.create_optimal_strategy(iterations=20).strategy)
+        for path, frequencies in strategies[1].items():
+            for action, hand_frequencies in frequencies.items():
+                np.testing.assert_allclose(strategies[0][path][action], hand_frequencies)
+        with self.assertRaises(ValueError):
+            solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', (.5, 1), 1)
+        with self.assertRaises(ValueError):
+            solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, 1).resized(
+                (.5, 1), 1)
+
+    def test_counter_strategy(self):
+        tree = strategy.StrategyTree(self.board2, 1, 2, .5)
+        hero_range = poker.Range({tuple(self.pocket_queens): 1,
+                                  tuple(poker.make_hand('8c 5c')): 1})
+        for plan, weight in zip(tree.get_plans('oop'), (.25, .5, .5, .75)):
+            plan_range = poker.Range(hero_range.weights * weight)
+            tree.modify_nodes_by_plan(plan, plan_range)
+        for player in ('ip', 'oop'):
+            expected = 0
+            for hand, weight in self.rangeAKQ.hand_weights.items():
+                ev_r, plan_r = tree.get_highest_ev_plan(player, hand,
+                                                        tree.child(tree.root, 'r'), 'r')
+                ev_c, plan_c = tree.get_highest_ev_plan(player, hand,
+                                                        tree.child(tree.root, 'c'), 'c')
+                expected += weight * (ev_r + ev_c if player == 'ip' else max(ev_r, ev_c))
+            showdown = poker.Showdown(self.board2, hero_range, self.rangeAKQ)
+            self.assertAlmostEqual(tree.create_counter_strategy(player, self.rangeAKQ,
+                                                                showdown), expected)
+            info = tree.equity_cache.cache_info()
+            self.assertEqual(tree.get_highest_ev_plan(player, hand,
+                                                      tree.child(tree.root, 'c'), 'c'),
+                             (ev_c, plan_c))
+            self.assertGreater(tree.equity_cache.cache_info().hits, info.hits)
+
+    def test_incremental_strategy(self):
+        tree = strategy.StrategyTree(self.board2, 1, 2, .5)
+        combos = np.flatnonzero(self.rangeAKQ.weights)
+        showdown = poker.Showdown(self.board2, self.rangeAKQ, self.rangeAKQ)
+        rng = np.random.default_rng(0)
+        plan_weights = rng.random((len(tree.get_plans('oop')), len(combos)))
+        for _ in range(5):
+            plan_weights[rng.integers(len(plan_weights)), rng.integers(len(combos))] = 0
+            tree.set_strategy('oop', plan_weights, combos)
+            ev = tree.create_counter_strategy('ip', self.rangeAKQ, showdown)
+            fresh = strategy.StrategyTree(self.board2, 1, 2, .5)
+            fresh.set_strategy('oop', plan_weights, combos)
+            np.testing.assert_allclose(tree.ranges, fresh.ranges)
+            self.assertAlmostEqual(ev, fresh.create_counter_strategy('ip', self.rangeAKQ,
+                                                                     showdown))
+
+    def test_lru_cache(self):
+        cache = strategy.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.cache_info(), strategy.CacheInfo(2, 1, 2, 2))
+
+        s = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5,
+                          cache_size=8)
+        s.create_optimal_strategy()
+        self.assertEqual(s.strategy_tree.equity_cache.cache_info().maxsize, 8)
+        self.assertLessEqual(s.strategy_tree.equity_cache.cache_info().currsize, 8)
+        self.assertEqual(s.resized(1, .5).strategy_tree.equity_cache.maxsize, 8)
+        resized = s.resized(1, .5, cache_size=4)
+        self.assertEqual(resized.strategy_tree.equity_cache.maxsize, 4)
+
+    def test_strategy_gradient(self):
+        villain_range = poker.Range({tuple(self.pocket_kings): 1,
+                                     tuple(poker.make_hand('8c 5c')): 1,
+                                     tuple(poker.make_hand('As 2s')): 1})
+        for hero in ('ip', 'oop'):
+            s = solver.Solver(self.board2, self.rangeAKQ, villain_range, hero, .5, 1)
+            num_args = len(s.strategy_tree.get_plans(hero)) * len(s.hero_combos)
+            arr = np.random.default_rng(0).random(num_args)
+            value, gradient = s.evaluate_strategy(arr, gradient=True)
+            self.assertAlmostEqual(value, s.evaluate_strategy(arr))
+            np.testing.assert_allclose(
+                gradient, approx_fprime(arr, s.evaluate_strategy, 1e-6), atol=1e-4)
+
     def test_solver(self):
         s = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5)
         strat = s.create_optimal_strategy()
@@ -86,6 +379,279 @@ class TestPoker(unittest.TestCase):
         opp_value = s.evaluate_strategy(strat.x)
         self.assertAlmostEqual(3.167, opp_value, places=3)
 
+    def test_dominated_plans(self):
+        expected = {'ip': {('cc', 'AsAc'), ('rc', 'QdQc'), ('rf', 'AsAc')},
+                    'oop': {('crc', 'QdQc'), ('crf', 'AsAc')}}
+        for hero, value in (('ip', 2.833), ('oop', 3.167)):
+            s = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, hero, .5, .5,
+                              prune_plans=True)
+            hands = [''.join(str(card) for card in poker.COMBOS[combo])
+                     for combo in s.solve_showdown.hero_combos]
+            plans = s.strategy_tree.get_plans(hero)
+            dominated = {(plans[i], hands[j]) for i, j in zip(*s.dominated.nonzero())}
+            self.assertEqual(dominated, expected[hero])
+            x = s.create_optimal_strategy().x.reshape(len(plans), -1)
+            self.assertFalse(x[s.dominated].any())
+            unpruned = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, hero, .5,
+                                     .5)
+            self.assertFalse(unpruned.dominated.any())
+            self.assertAlmostEqual(unpruned.create_optimal_strategy().fun, value,
+                                   places=3)
+
+    def test_iter_strategies(self):
+        s = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5)
+        steps = list(s.iter_strategies())
+        self.assertEqual([step.iteration for step in steps], [1])
+        self.assertAlmostEqual(steps[0].fun, 2.833, places=3)
+        self.assertAlmostEqual(s.evaluate_strategy(steps[0].x), steps[0].fun)
+
+        threads = threading.active_count()
+        steps = s.iter_strategies()
+        next(steps)
+        steps.close()
+        self.assertEqual(threading.active_count(), threads)
+        # Out of time before the program is solved, so the starting strategy is given.
+        steps = list(s.iter_strategies(time_limit=0))
+        self.assertEqual([step.iteration for step in steps], [0])
+        self.assertAlmostEqual(s.evaluate_strategy(steps[0].x), steps[0].fun)
+        self.assertEqual(threading.active_count(), threads)
+
+        async def first_steps(problem, count, *args):
+            async for step in solver.iter_strategies_async(problem, *args):
+                if step.iteration == count:
+                    return step
+        self.assertEqual(asyncio.run(first_steps(s, 1)).iteration, 1)
+        s = solver.CFRSolver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5)
+        step = asyncio.run(first_steps(s, 5, 10))
+        self.assertAlmostEqual(s.evaluate_strategy(step.x), step.fun)
+
+        # Time out in the middle of a step: the step finishes in the executor, which the
+        # loop waits for when it shuts down, and the iterator is closed after it.
+        s = solver.CFRSolver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip',
+                             (.33, .75, 1.5), 20)
+        iterators = []
+        iter_strategies = s.iter_strategies
+
+        def recorded(*args):
+            iterators.append(iter_strategies(*args))
+            return iterators[-1]
+        s.iter_strategies = recorded
+
+        async def consume():
+            async for step in solver.iter_strategies_async(s, 100):
+                pass
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(consume(), .01))
+        self.assertEqual(inspect.getgeneratorstate(iterators[0]), inspect.GEN_CLOSED)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(s.create_optimal_strategy(iterations=1).nit, 1)
+
+    def test_parallel_solver(self):
+        s = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5,
+                          workers=2)
+        strat = s.create_optimal_strategy()
+        self.assertAlmostEqual(2.833, strat.fun, places=3)
+        self.assertIsNone(s.parallel_best_response)
+
+    def test_exploitability(self):
+        s = solver.CFRSolver(self.board2, self.rangeAKQ, self.rangeAKQ, 'oop', .5, .5,
+                             reduce_suits=False)
+        strat = s.create_optimal_strategy(iterations=300, target_exploitability=.05)
+        self.assertLess(strat.nit, 300)
+        self.assertLessEqual(strat.exploitability[-1], .05)
+        strategies = {player: s.get_plan_weights(player)
+                      for player in (s.villain, s.hero)}
+        hand_ranges = {s.villain: s.villain_range, s.hero: s.hero_range}
+        exploitability, values = s.strategy_tree.exploitability(strategies, hand_ranges,
+                                                                s.showdown)
+        self.assertAlmostEqual(exploitability, s.get_exploitability())
+        ev, villain_weights = s.strategy_tree.best_response(
+            s.villain, strategies[s.hero], s.villain_range, s.showdown)
+        self.assertAlmostEqual(ev, values[s.villain])
+        self.assertAlmostEqual(ev, s.evaluate_strategy(strat.x))
+        facing_bet = [plan[0] == 'r' for plan in s.strategy_tree.get_plans(s.villain)]
+        np.testing.assert_allclose(villain_weights[facing_bet].sum(axis=0),
+                                   self.rangeAKQ.weights[s.showdown.villain_combos])
+
+    def test_sweep(self):
+        sizes = [(.5, .5), (.5, 1), (1, 1)]
+        results = solver.sweep(self.board2, self.rangeAKQ, self.rangeAKQ, sizes)
+        for (bet_size, stack_size), result in zip(sizes, results):
+            s = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', bet_size,
+                              stack_size)
+            self.assertAlmostEqual(result.fun, s.create_optimal_strategy().fun, places=3)
+            self.assertAlmostEqual(result.fun, s.evaluate_strategy(result.x), places=6)
+        results = solver.sweep(self.board2, self.rangeAKQ, self.rangeAKQ, sizes,
+                               method='cfr', iterations=200)
+        self.assertAlmostEqual(results[0].fun, 2.833, places=2)
+        self.assertLess(results[-1].exploitability[-1], .01)
+
+        # Warm starting only visits the decisions the other solver has. With a stack of
+        # .5 the bet of 1 is all in like the bet of .5, so every decision matches, while
+        # with a stack of 1 each has another raise and nothing is copied.
+        small = solver.CFRSolver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5)
+        same, larger = small.resized((.5, 1), .5), small.resized((.5, 1), 1)
+        same.warm_start(small)
+        self.assertEqual(same.strategy_tree.num_nodes, 1)
+        small.create_optimal_strategy(iterations=10)
+        same.warm_start(small)
+        larger.warm_start(small)
+        for path in ('', 'c', 'r', 'cr'):
+            regrets = small.decisions[small.strategy_tree.node(path)]['regrets']
+            np.testing.assert_array_equal(
+                same.decisions[same.strategy_tree.node(path)]['regrets'], regrets)
+            self.assertFalse(
+                larger.decisions[larger.strategy_tree.node(path)]['regrets'].any())
+
+    def test_batch(self):
+        # The last board has a card to come, so its solve raises.
+        boards = ['2h 3h 4d 6d 7s', '7s 6d 4d 3h 2h', 'As Ks 8s 5s 2s', '2h 3h 4d 6d']
+        with tempfile.TemporaryDirectory() as directory:
+            results_path = os.path.join(directory, 'results.jsonl')
+            with open(results_path, 'w') as results_file:
+                results_file.write('{"board": "2s 5s')
+            self.assertEqual(batch.solve_boards(boards, self.rangeAKQ, self.rangeAKQ,
+                                                results_path, workers=1, bet_size=.5,
+                                                stack_size=.5), 2)
+            self.assertEqual(batch.solve_boards(boards, self.rangeAKQ, self.rangeAKQ,
+                                                results_path, workers=1), 0)
+            self.assertEqual(batch.completed_boards(results_path),
+                             {'2h 3h 4d 6d 7s', '2s 5s 8s Ks As'})
+            with open(results_path) as results_file:
+                results = [json.loads(line) for line in results_file.readlines()[1:]]
+        values = {result['board']: result['value'] for result in results
+                  if 'error' not in result}
+        errors = [result for result in results if 'error' in result]
+        self.assertEqual([error['board'] for error in errors], ['2h 3h 4d 6d'] * 2)
+        self.assertTrue(errors[0]['error'].startswith('ValueError: '))
+        self.assertAlmostEqual(values['2h 3h 4d 6d 7s'], 2.833, places=3)
+        self.assertEqual(batch.parse_range('QcQd KcKd AsAc').weights.tolist(),
+                         self.rangeAKQ.weights.tolist())
+
+    def test_store(self):
+        hero_range = poker.Range({tuple(self.pocket_queens): 1,
+                                  tuple(self.pocket_kings): .5,
+                                  tuple(self.pocket_aces): 2})
+        s = solver.Solver(self.board2, hero_range, self.rangeAKQ, 'oop', .5, .5)
+        result = s.create_optimal_strategy()
+        record = batch.solve_board(self.board2, hero_range, self.rangeAKQ, 'ip', .5, .5)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'strategies.bin')
+            store.save(path, [store.solver_solution(s, result),
+                              store.batch_solution(record, hero_range, self.rangeAKQ)],
+                       np.float16)
+            strategies = store.StrategyStore(path)
+            self.assertEqual(len(strategies), 2)
+
+            key = store.solution_key(list(reversed(self.board2)), hero_range,
+                                     self.rangeAKQ, 'oop', .5, .5)
+            plans = s.strategy_tree.get_plans('oop')
+            self.assertEqual(strategies.get_plans(key), plans)
+            self.assertAlmostEqual(strategies.value(key), result.fun)
+            weights = result.x.reshape(len(plans), -1)
+            for hand, column in zip(s.hero_combos, weights.T):
+                frequencies = strategies.frequencies(key, poker.COMBOS[hand])
+                np.testing.assert_allclose([frequencies[plan] for plan in plans],
+                                           column / hero_range.weights[hand], atol=1e-3)
+
+            key = store.solution_key(self.board2, hero_range, self.rangeAKQ, 'ip', .5,
+                                     .5)
+            frequencies = strategies.frequencies(key, self.pocket_aces)
+            self.assertAlmostEqual(sum(frequencies[plan] for plan in frequencies
+                                       if plan[0] == 'r'), 1, places=2)
+            self.assertNotIn(store.solution_key(self.board2, hero_range, self.rangeAKQ,
+                                                'ip', 1, .5), strategies)
+            with self.assertRaises(KeyError):
+                strategies.frequencies(key, self.pocket_fives)
+            del strategies
+
+            # Every hand with 30 plans, so that offsets pass the range of an int16.
+            plans = ['p{}'.format(i) for i in range(30)]
+            combos = np.arange(poker.NUM_COMBOS)
+            frequencies = np.random.default_rng(0).random((len(plans), len(combos)))
+            key = bytes(16)
+            store.save(path, [(key, plans, combos, frequencies, 0)])
+            strategies = store.StrategyStore(path)
+            for combo in (0, 1092, 1320, poker.NUM_COMBOS - 1):
+                np.testing.assert_allclose(
+                    list(strategies.frequencies(key, poker.COMBOS[combo]).values()),
+                    frequencies[:, combo], rtol=1e-6)
+            del strategies
+
+    def test_instrumentation(self):
+        iterations = []
+        with instrument.recording():
+            s = solver.Solver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5)
+            strat = s.create_optimal_strategy(
+                callback=lambda iteration, report: iterations.append(iteration))
+        self.assertFalse(instrument.enabled)
+        counters = strat.report['counters']
+        self.assertEqual(counters.get('solver_iterations', 0), strat.nit)
+        self.assertEqual(iterations, [strat.nit])
+        self.assertGreaterEqual(counters['objective_evaluations'], 1)
+        self.assertEqual(strat.report['timers']['linear_program']['calls'], 1)
+        self.assertEqual(strat.report['timers']['solve']['calls'], 1)
+
+        instrument.reset()
+        poker.evaluate_hand(poker.make_hand('As Ks Qs Js Ts'))
+        self.assertEqual(instrument.report(), {'counters': {}, 'timers': {}})
+
+    def test_solver_matches_cfr(self):
+        # CFR's average strategies bracket the value of the game: the villain's best
+        # response to the hero's is at least the optimum, and the exploitability is at
+        # least the gap, so the optimum found by Solver must lie between them.
+        def hand_range(hand_weights):
+            return poker.Range({tuple(poker.make_hand(hand)): weight
+                                for hand, weight in hand_weights.items()})
+
+        # Where a subgradient of the best response stopped SLSQP at a kink, at 6.375.
+        s = solver.Solver(poker.make_hand('3s Kd 6c 7s 4s'),
+                          hand_range({'3h Ts': 2, '8c Jd': .5}),
+                          hand_range({'8h 8d': 1, '3d As': .5, '3h Td': 1}), 'ip', 1, 1,
+                          prune_plans=False)
+        self.assertAlmostEqual(s.create_optimal_strategy().fun, 4.25)
+        # Where pruning stopped SLSQP at 12 after two iterations.
+        s = solver.Solver(poker.make_hand('4d As Kc Th 5s'),
+                          hand_range({'3h Js': 2, '3d 9d': 1, '6s 7s': 2, '9c Td': 2}),
+                          hand_range({'3s Js': .5, '8c Qc': .5, '9s 9d': 2}), 'oop', 1, 2,
+                          prune_plans=True)
+        self.assertAlmostEqual(s.create_optimal_strategy().fun, 9)
+
+        rng = np.random.default_rng(7)
+        for _ in range(12):
+            cards = [poker.DECK[i]
+                     for i in rng.choice(len(poker.DECK), 17, replace=False)]
+            board, hands = cards[:5], list(zip(cards[5::2], cards[6::2]))
+            num_hero_hands = rng.integers(1, 5)
+            hero_range, villain_range = (
+                poker.Range({hand: rng.choice((.5, 1, 2)) for hand in range_hands})
+                for range_hands in (hands[:num_hero_hands],
+                                    hands[num_hero_hands:rng.integers(num_hero_hands + 1,
+                                                                      7)]))
+            hero = rng.choice(('ip', 'oop'))
+            bet_size, stack_size = rng.choice((.5, 1)), rng.choice((.5, 1, 2))
+            cfr = solver.CFRSolver(board, hero_range, villain_range, hero, bet_size,
+                                   stack_size).create_optimal_strategy(iterations=100)
+            for prune_plans in (True, False):
+                s = solver.Solver(board, hero_range, villain_range, hero, bet_size,
+                                  stack_size, prune_plans=prune_plans)
+                value = s.create_optimal_strategy().fun
+                self.assertLessEqual(value, cfr.fun + 1e-6)
+                self.assertGreaterEqual(value, cfr.fun - cfr.exploitability[-1] - 1e-6)
+
+    def test_cfr_solver(self):
+        for hero, expected in (('ip', 2.833), ('oop', 3.167)):
+            s = solver.CFRSolver(self.board2, self.rangeAKQ, self.rangeAKQ, hero, .5, .5)
+            strat = s.create_optimal_strategy(iterations=300)
+            self.assertAlmostEqual(expected, s.evaluate_strategy(strat.x), places=2)
+            self.assertEqual(len(strat.exploitability), 300)
+            self.assertLess(strat.exploitability[-1], .01)
+            self.assertLess(strat.exploitability[-1], strat.exploitability[0])
+            self.assertFalse(s.dominated.any())
+        with self.assertRaises(TypeError):
+            solver.CFRSolver(self.board2, self.rangeAKQ, self.rangeAKQ, 'ip', .5, .5,
+                             workers=2)
+
 
 if __name__ == '__main__':
     unittest.main()